@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for lv2 bundle extraction.
+
+Each bundle is measured in four separate stages:
+- parse: reading manifest.ttl and all seeAlso files into the rdf graph
+- extract: building bundle.data from an already parsed graph
+- checksum: hashing all files of the bundle
+- package: building a BundlePackage, the way bundles are uploaded
+
+Besides the test bundles (invada.lv2 and calf.lv2), synthetic bundles can be
+generated with any number of plugins, ports, scale points, presets and seeAlso
+files, so that hot paths of rdfmodel and lv2 can be stressed in isolation.
+
+Results are printed as one json document per line, so they can be appended
+to a file and compared over time:
+
+    python -m modcommon.benchmark --units units.ttl >> bench_output.txt
+"""
+
+import os, sys, json, time, shutil, tempfile, platform, argparse
+
+from modcommon.lv2 import Bundle, BundlePackage
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+FIXTURES = [ os.path.join(ROOT, 'tests', 'invada.lv2'),
+             os.path.join(ROOT, 'tests', 'calf.lv2'),
+             ]
+
+STAGES = ('parse', 'extract', 'checksum', 'package')
+
+PREFIXES = """@prefix lv2:   <http://lv2plug.in/ns/lv2core#> .
+@prefix rdf:   <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
+@prefix rdfs:  <http://www.w3.org/2000/01/rdf-schema#> .
+@prefix doap:  <http://usefulinc.com/ns/doap#> .
+@prefix foaf:  <http://xmlns.com/foaf/0.1/> .
+@prefix units: <http://lv2plug.in/ns/extensions/units#> .
+@prefix pset:  <http://lv2plug.in/ns/ext/presets#> .
+
+"""
+
+def generate_bundle(path, plugins=10, ports=8, scale_points=0, presets=0, see_also=1):
+    """
+    Writes a synthetic lv2 bundle in path, which must not exist.
+
+    Each plugin has one stereo pair of audio ports and `ports` control input ports,
+    each of them with `scale_points` scale points. Every plugin gets `presets` presets,
+    all of them in presets.ttl, and its ports are spread over `see_also` ttl files.
+    All plugins share a single (empty) binary.
+    """
+    assert see_also >= 1
+    os.mkdir(path)
+    name = os.path.basename(os.path.realpath(path)).split('.')[0]
+    binary = '%s.so' % name
+    open(os.path.join(path, binary), 'w').close()
+
+    manifest = [ PREFIXES ]
+    preset_ttl = [ PREFIXES ]
+
+    for p in range(plugins):
+        url = 'http://portalmod.com/plugins/synthetic/%s/%d' % (name, p)
+        files = [ 'plugin%d_%d.ttl' % (p, f) for f in range(see_also) ]
+
+        manifest.append('<%s> a lv2:Plugin ;\n    lv2:binary <%s> ;\n    rdfs:seeAlso %s .\n\n' %
+                        (url, binary, ', '.join([ '<%s>' % f for f in files ])))
+
+        port_defs = [ _audio_port(0, 'in_l', 'lv2:InputPort'),
+                      _audio_port(1, 'in_r', 'lv2:InputPort'),
+                      _audio_port(2, 'out_l', 'lv2:OutputPort'),
+                      _audio_port(3, 'out_r', 'lv2:OutputPort'),
+                      ]
+        port_defs += [ _control_port(4 + i, i, scale_points) for i in range(ports) ]
+
+        # First file holds the plugin description, ports are distributed among all files
+        chunks = [ [] for f in files ]
+        for i, port in enumerate(port_defs):
+            chunks[i % len(files)].append(port)
+
+        for f, chunk in enumerate(chunks):
+            ttl = [ PREFIXES ]
+            if f == 0:
+                ttl.append('<%s> a lv2:Plugin, lv2:DelayPlugin ;\n' % url)
+                ttl.append('    doap:name "Synthetic %s %d" ;\n' % (name, p))
+                ttl.append('    doap:license <http://usefulinc.com/doap/licenses/gpl> ;\n')
+                ttl.append('    doap:maintainer [ foaf:name "MOD" ; foaf:mbox <mailto:mod@portalmod.com> ] ;\n')
+                ttl.append('    lv2:minorVersion 2 ;\n    lv2:microVersion 0 ;\n')
+            else:
+                ttl.append('<%s>\n' % url)
+            if chunk:
+                ttl.append('    lv2:port %s .\n' % ' ,\n    '.join(chunk))
+            else:
+                ttl.append('    rdfs:comment "no ports here" .\n')
+            open(os.path.join(path, files[f]), 'w').write(''.join(ttl))
+
+        for i in range(presets):
+            preset_url = '%s#preset%d' % (url, i)
+            manifest.append('<%s> a pset:Preset ;\n    lv2:appliesTo <%s> ;\n    rdfs:seeAlso <presets.ttl> .\n\n' %
+                            (preset_url, url))
+            values = [ '[ lv2:symbol "control%d" ; pset:value %f ]' % (c, (i + c) % 10 / 10.0)
+                       for c in range(ports) ]
+            preset_ttl.append('<%s> a pset:Preset ;\n    lv2:appliesTo <%s> ;\n    rdfs:label "Preset %d" ' %
+                              (preset_url, url, i))
+            if values:
+                preset_ttl.append(';\n    lv2:port %s ' % ' ,\n    '.join(values))
+            preset_ttl.append('.\n\n')
+
+    open(os.path.join(path, 'manifest.ttl'), 'w').write(''.join(manifest))
+    if presets:
+        open(os.path.join(path, 'presets.ttl'), 'w').write(''.join(preset_ttl))
+
+    return path
+
+def _audio_port(index, symbol, direction):
+    return ('[ a lv2:AudioPort, %s ; lv2:index %d ; lv2:symbol "%s" ; lv2:name "%s" ]' %
+            (direction, index, symbol, symbol.replace('_', ' ').title()))
+
+def _control_port(index, number, scale_points):
+    port = ('[ a lv2:ControlPort, lv2:InputPort ; lv2:index %d ; lv2:symbol "control%d" ; '
+            'lv2:name "Control %d" ; lv2:default 0.5 ; lv2:minimum 0.0 ; lv2:maximum 1.0 ; '
+            'units:unit units:db' % (index, number, number))
+    for i in range(scale_points):
+        port += ' ; lv2:scalePoint [ rdfs:label "Point %d" ; rdf:value %d ]' % (i, i)
+    return port + ' ]'
+
+def _summary(times):
+    times = sorted(times)
+    return { 'min': times[0],
+             'median': times[len(times) / 2],
+             'mean': sum(times) / len(times),
+             'max': times[-1],
+             }
+
+def measure(path, stage, repeat=3, units_file=None):
+    """
+    Runs one stage against bundle in path `repeat` times. Returns a dictionary
+    with the wall time summary, in seconds.
+    """
+    kwargs = {}
+    if units_file:
+        kwargs['units_file'] = units_file
+
+    times = []
+    for i in range(repeat):
+        if stage == 'parse':
+            start = time.time()
+            Bundle(path, **kwargs)
+        elif stage == 'extract':
+            bundle = Bundle(path, **kwargs)
+            start = time.time()
+            bundle.extract_data()
+        elif stage == 'checksum':
+            bundle = Bundle(path, **kwargs)
+            start = time.time()
+            bundle.checksum()
+        elif stage == 'package':
+            start = time.time()
+            BundlePackage(path, **kwargs).close()
+        else:
+            raise Exception("Unknown stage: %s" % stage)
+        times.append(time.time() - start)
+
+    result = { 'bundle': os.path.basename(os.path.realpath(path)),
+               'stage': stage,
+               'repeat': repeat,
+               }
+    result.update(_summary(times))
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks lv2 bundle extraction")
+    parser.add_argument('bundles', nargs='*',
+                        help="bundles to measure, defaults to the test bundles")
+    parser.add_argument('--units', help="path to units.ttl")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help="stages to run, defaults to all")
+    parser.add_argument('--plugins', type=int, default=0,
+                        help="also measure a synthetic bundle with this number of plugins")
+    parser.add_argument('--ports', type=int, default=8)
+    parser.add_argument('--scale-points', type=int, default=0)
+    parser.add_argument('--presets', type=int, default=0)
+    parser.add_argument('--see-also', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    paths = args.bundles or list(FIXTURES)
+
+    tmp_dir = tempfile.mkdtemp()
+    synthetic = None
+    try:
+        if args.plugins:
+            synthetic = generate_bundle(os.path.join(tmp_dir, 'synthetic.lv2'),
+                                        plugins=args.plugins,
+                                        ports=args.ports,
+                                        scale_points=args.scale_points,
+                                        presets=args.presets,
+                                        see_also=args.see_also)
+            paths.append(synthetic)
+
+        info = { 'timestamp': int(time.time()),
+                 'python': platform.python_version(),
+                 'machine': platform.machine(),
+                 }
+        params = { 'plugins': args.plugins,
+                   'ports': args.ports,
+                   'scale_points': args.scale_points,
+                   'presets': args.presets,
+                   'see_also': args.see_also,
+                   }
+
+        for path in paths:
+            for stage in args.stage or STAGES:
+                result = measure(path, stage, args.repeat, args.units)
+                result.update(info)
+                if path == synthetic:
+                    result['synthetic'] = params
+                print json.dumps(result, sort_keys=True)
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
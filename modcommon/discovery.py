@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast discovery of the plugins declared by lv2 bundles.
+
+Listing installed plugins only requires manifest.ttl, and only three kinds of
+statements from it: `a lv2:Plugin`, `lv2:binary` and `rdfs:seeAlso`. Instead of
+a full rdflib parse, manifest.ttl is scanned by a minimal turtle tokenizer, which
+understands the subset of turtle that manifests are written in. Whenever it finds
+something outside this subset (blank nodes, collections, sparql directives),
+discovery falls back to rdflib, so the result is always the same.
+
+rdflib is only imported by the fallback, so this module is cheap to import.
+"""
+
+import os, re, urllib, urlparse
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_SEEALSO = 'http://www.w3.org/2000/01/rdf-schema#seeAlso'
+LV2_PLUGIN = 'http://lv2plug.in/ns/lv2core#Plugin'
+LV2_BINARY = 'http://lv2plug.in/ns/lv2core#binary'
+
+class Unsupported(Exception):
+    pass
+
+TOKENS = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<string>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^'\\]|\\.|'(?!\'\'))*\'\'\'|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<lang>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<datatype>\^\^)
+  | (?P<number>[+-]?(?:\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?))
+  | (?P<pname>(?:[A-Za-z][\w-]*(?:\.[\w-]+)*)?:(?:[\w:%-]+(?:\.[\w:%-]+)*)?)
+  | (?P<keyword>a\b|true\b|false\b)
+  | (?P<punct>[.;,])
+  ''', re.VERBOSE)
+
+def tokenize(text):
+    pos = 0
+    end = len(text)
+    while pos < end:
+        match = TOKENS.match(text, pos)
+        if match is None:
+            # blank nodes, collections, sparql style directives...
+            raise Unsupported("Unexpected input at char %d: %r" % (pos, text[pos:pos+20]))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        yield kind, match.group(kind)
+
+class ManifestScanner(object):
+    """
+    Extracts (subject, predicate, object) triples from a turtle document,
+    with all iris expanded and literals discarded.
+    """
+
+    def __init__(self, text, base):
+        self.tokens = list(tokenize(text))
+        self.pos = 0
+        self.base = base
+        self.prefixes = {}
+
+    def next(self):
+        try:
+            token = self.tokens[self.pos]
+        except IndexError:
+            raise Unsupported("Unexpected end of document")
+        self.pos += 1
+        return token
+
+    def peek(self):
+        try:
+            return self.tokens[self.pos]
+        except IndexError:
+            return None, None
+
+    def resolve(self, kind, value):
+        if kind == 'iri':
+            return urlparse.urljoin(self.base, value[1:-1])
+        if kind == 'pname':
+            prefix, local = value.split(':', 1)
+            try:
+                return self.prefixes[prefix] + local
+            except KeyError:
+                raise Unsupported("Undeclared prefix: %s" % prefix)
+        if kind == 'keyword' and value == 'a':
+            return RDF_TYPE
+        raise Unsupported("Unexpected %s: %s" % (kind, value))
+
+    def directive(self, name):
+        if name == '@prefix':
+            kind, prefix = self.next()
+            if kind != 'pname' or not prefix.endswith(':'):
+                raise Unsupported("Bad prefix declaration")
+            kind, iri = self.next()
+            if kind != 'iri':
+                raise Unsupported("Bad prefix declaration")
+            self.prefixes[prefix[:-1]] = self.resolve(kind, iri)
+        elif name == '@base':
+            kind, iri = self.next()
+            if kind != 'iri':
+                raise Unsupported("Bad base declaration")
+            self.base = self.resolve(kind, iri)
+        else:
+            raise Unsupported("Unknown directive %s" % name)
+        if self.next() != ('punct', '.'):
+            raise Unsupported("Directive must end with '.'")
+
+    def object(self):
+        kind, value = self.next()
+        if kind in ('iri', 'pname'):
+            return self.resolve(kind, value)
+        if kind == 'string':
+            # discard language tags and datatypes
+            if self.peek()[0] == 'lang':
+                self.next()
+            elif self.peek()[0] == 'datatype':
+                self.next()
+                self.resolve(*self.next())
+            return None
+        if kind == 'number' or (kind == 'keyword' and value in ('true', 'false')):
+            return None
+        raise Unsupported("Unexpected %s: %s" % (kind, value))
+
+    def triples(self):
+        while self.pos < len(self.tokens):
+            kind, value = self.next()
+            if kind == 'lang' and value in ('@prefix', '@base'):
+                self.directive(value)
+                continue
+
+            subject = self.resolve(kind, value)
+            while True:
+                predicate = self.resolve(*self.next())
+                while True:
+                    obj = self.object()
+                    if obj is not None:
+                        yield subject, predicate, obj
+                    if self.peek() != ('punct', ','):
+                        break
+                    self.next()
+                token = self.next()
+                # a trailing ';' before '.' is allowed
+                while token == ('punct', ';') and self.peek() == ('punct', ';'):
+                    token = self.next()
+                if token == ('punct', ';') and self.peek() == ('punct', '.'):
+                    token = self.next()
+                if token == ('punct', '.'):
+                    break
+                if token != ('punct', ';'):
+                    raise Unsupported("Unexpected %s: %s" % token)
+
+def _path(url):
+    if not url.startswith('file://'):
+        return url
+    return urllib.unquote(url[len('file://'):])
+
+def _collect(triples):
+    plugins = set()
+    binaries = {}
+    see_also = {}
+
+    for subject, predicate, obj in triples:
+        if predicate == RDF_TYPE and obj == LV2_PLUGIN:
+            plugins.add(subject)
+        elif predicate == LV2_BINARY:
+            binaries[subject] = _path(obj)
+        elif predicate == RDFS_SEEALSO:
+            see_also.setdefault(subject, []).append(_path(obj))
+
+    result = {}
+    for url in plugins:
+        result[unicode(url)] = { 'binary': binaries.get(url),
+                                 'seeAlso': sorted(see_also.get(url, [])),
+                                 }
+    return result
+
+def _rdflib_triples(path):
+    import rdflib
+    graph = rdflib.ConjunctiveGraph()
+    graph.parse('file://%s' % path, format='n3')
+    for subject, predicate, obj in graph:
+        if isinstance(obj, rdflib.Literal):
+            continue
+        yield unicode(subject), unicode(predicate), unicode(obj)
+
+def discover(path):
+    """
+    Returns the plugins declared in manifest.ttl of bundle in path, as a dictionary
+    of plugin url => { 'binary': path, 'seeAlso': [ path, ... ] }.
+    """
+    path = os.path.realpath(path)
+    if not path.endswith('manifest.ttl'):
+        path = os.path.join(path, 'manifest.ttl')
+
+    text = open(path).read().decode('utf-8')
+    try:
+        return _collect(ManifestScanner(text, 'file://%s' % urllib.quote(path)).triples())
+    except Unsupported:
+        return _collect(_rdflib_triples(path))
+
+def discover_all(lv2_path):
+    """
+    Discovers plugins in all bundles found in lv2_path directory. Returns a dictionary of
+    bundle path => plugins, as returned by discover()
+    """
+    bundles = {}
+    for name in sorted(os.listdir(lv2_path)):
+        path = os.path.join(lv2_path, name)
+        if os.path.exists(os.path.join(path, 'manifest.ttl')):
+            bundles[os.path.realpath(path)] = discover(path)
+    return bundles
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline measurement of the cpu cost of plugins.
+
+A plugin instance is fed with synthetic audio (white noise) and run for a number
+of blocks at several block sizes, measuring the cpu time of each run() call.
+Results report percentiles of time per block and the real-time factor, which is
+the fraction of one block duration spent processing it: a plugin with
+realtime_factor 0.05 uses 5% of the cpu available to the audio thread.
+
+Any instance with connect(), activate(), run() and deactivate() methods can be
+measured, like ladspa.Instance and lv2.Instance. Buffers are float32 arrays, either
+numpy arrays (if numpy is available) or array.array('f'), and are passed to plugins
+without copying.
+
+    python -m modcommon.dsp ladspa /usr/lib/ladspa/amp.so --index 1
+    python -m modcommon.dsp lv2 /usr/lib/lv2/amp.lv2 http://lv2plug.in/plugins/eg-amp
+"""
+
+import sys, json, time, array, ctypes, random, argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BLOCK_SIZES = (64, 128, 256, 512)
+PERCENTILES = (50, 90, 99)
+
+# time.clock is the process cpu time on unix
+cpu_time = time.clock
+
+def float_buffer(size):
+    if numpy is not None:
+        return numpy.zeros(size, dtype=numpy.float32)
+    return array.array('f', [0.0] * size)
+
+def float_pointer(buf):
+    """
+    Returns a float* pointing to buffer memory
+    """
+    if numpy is not None and isinstance(buf, numpy.ndarray):
+        assert buf.dtype == numpy.float32 and buf.flags['C_CONTIGUOUS']
+        return buf.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    assert buf.typecode == 'f' and buf.itemsize == 4
+    address, length = buf.buffer_info()
+    return ctypes.cast(address, ctypes.POINTER(ctypes.c_float))
+
+def noise_buffer(size, amplitude=0.5):
+    buf = float_buffer(size)
+    for i in range(size):
+        buf[i] = random.uniform(-amplitude, amplitude)
+    return buf
+
+def percentile(values, point):
+    """
+    Percentile of a sorted list, by nearest rank
+    """
+    rank = int(round(point / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def summary(times, block_size, sample_rate):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    result = { 'block_size': block_size,
+               'blocks': len(times),
+               'mean_us': mean * 1e6,
+               'max_us': times[-1] * 1e6,
+               'realtime_factor': mean * sample_rate / block_size,
+               }
+    for point in PERCENTILES:
+        result['p%d_us' % point] = percentile(times, point) * 1e6
+    return result
+
+def benchmark(instance, audio_inputs, audio_outputs, controls, sample_rate,
+              block_sizes=BLOCK_SIZES, blocks=1000, warmup=10):
+    """
+    Measures cpu time of instance.run() for each block size.
+
+    audio_inputs and audio_outputs are lists of port indexes, controls is a dictionary
+    of port index => value, for both input and output control ports.
+    Returns a list of summaries, one per block size.
+    """
+    for port, value in controls.items():
+        buf = float_buffer(1)
+        buf[0] = value
+        instance.connect(port, buf)
+
+    results = []
+    for block_size in block_sizes:
+        for port in audio_inputs:
+            instance.connect(port, noise_buffer(block_size))
+        for port in audio_outputs:
+            instance.connect(port, float_buffer(block_size))
+
+        instance.activate()
+        try:
+            for i in range(warmup):
+                instance.run(block_size)
+
+            times = []
+            for i in range(blocks):
+                start = cpu_time()
+                instance.run(block_size)
+                times.append(cpu_time() - start)
+        finally:
+            instance.deactivate()
+
+        results.append(summary(times, block_size, sample_rate))
+
+    return results
+
+def control_value(port):
+    """
+    Value to be used for a control port: its default, or the minimum if there's no default
+    """
+    for key in ('default', 'minimum', 'maximum'):
+        if port.get(key) is not None:
+            return port[key]
+    return 0.0
+
+def benchmark_ladspa(path, index=0, sample_rate=48000, **kwargs):
+    from modcommon import ladspa
+
+    plugin = ladspa.Plugin(path, index)
+    instance = ladspa.Instance(plugin, sample_rate)
+
+    ports = plugin.ports
+    controls = {}
+    for port in ports['control']['input'] + ports['control']['output']:
+        controls[port['index']] = control_value(port)
+
+    try:
+        results = benchmark(instance,
+                            [ port['index'] for port in ports['audio']['input'] ],
+                            [ port['index'] for port in ports['audio']['output'] ],
+                            controls, sample_rate, **kwargs)
+    finally:
+        instance.cleanup()
+
+    return { 'path': path,
+             'index': index,
+             'unique_id': plugin.unique_id,
+             'label': plugin.label,
+             'sample_rate': sample_rate,
+             'results': results,
+             }
+
+def benchmark_lv2(plugin, sample_rate=48000, block_sizes=None, **kwargs):
+    """
+    Measures plugin given its data, as extracted by lv2.Bundle. By default, blocks
+    are run at the plugin's recommended buffer size. Result carries plugin's _id, so that
+    it can be stored with the plugin in catalog.
+    """
+    from modcommon import lv2
+
+    instance = lv2.Instance(plugin, sample_rate)
+
+    ports = plugin['ports']
+    controls = {}
+    for port in ports['control']['input'] + ports['control']['output']:
+        controls[port['index']] = control_value(port)
+
+    try:
+        results = benchmark(instance,
+                            [ port['index'] for port in ports['audio']['input'] ],
+                            [ port['index'] for port in ports['audio']['output'] ],
+                            controls, sample_rate,
+                            block_sizes=block_sizes or (plugin['bufsize'],),
+                            **kwargs)
+    finally:
+        instance.cleanup()
+
+    return { '_id': plugin['_id'],
+             'url': plugin['url'],
+             'sample_rate': sample_rate,
+             'results': results,
+             }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measures cpu cost of plugins")
+    parser.add_argument('--sample-rate', type=int, default=48000)
+    parser.add_argument('--blocks', type=int, default=1000)
+    parser.add_argument('--block-size', type=int, action='append',
+                        help="block sizes to measure, defaults to %s for ladspa and "
+                        "plugin's buffer size for lv2" % ', '.join(map(str, BLOCK_SIZES)))
+    sub = parser.add_subparsers(dest='kind')
+
+    ladspa_parser = sub.add_parser('ladspa')
+    ladspa_parser.add_argument('path')
+    ladspa_parser.add_argument('--index', type=int, default=0)
+
+    lv2_parser = sub.add_parser('lv2')
+    lv2_parser.add_argument('bundle')
+    lv2_parser.add_argument('url', nargs='?', help="plugin to measure, defaults to all in bundle")
+    lv2_parser.add_argument('--units', help="path to units.ttl")
+
+    args = parser.parse_args(argv)
+    kwargs = { 'blocks': args.blocks }
+
+    if args.kind == 'ladspa':
+        result = benchmark_ladspa(args.path, args.index, args.sample_rate,
+                                  block_sizes=args.block_size or BLOCK_SIZES, **kwargs)
+    elif args.kind == 'lv2':
+        from modcommon.lv2 import Bundle
+        if args.units:
+            bundle = Bundle(args.bundle, units_file=args.units)
+        else:
+            bundle = Bundle(args.bundle)
+        plugins = bundle.data['plugins']
+        urls = [ args.url ] if args.url else sorted(plugins.keys())
+        result = [ benchmark_lv2(plugins[url], args.sample_rate, args.block_size, **kwargs)
+                   for url in urls ]
+
+    print json.dumps(result, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,577 @@
 # -*- coding: utf-8 -*-
 
-import os, json
-from whoosh.fields import Schema, ID, TEXT, NGRAMWORDS, NUMERIC, STORED
+import os, re, gzip, json, math, time, heapq, atexit, bisect, shutil, hashlib, functools, threading
+from cStringIO import StringIO
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from whoosh.fields import Schema, ID, TEXT, KEYWORD, NGRAMWORDS, NUMERIC, STORED
 from whoosh.index import create_in, open_dir
-from whoosh.query import And, Or, Every, Term
+from whoosh.query import And, Or, Every, Term, NumericRange
 from whoosh.qparser import MultifieldParser
 from whoosh import sorting
 
+import tornado.gen
 import tornado.web
+import tornado.locks
+import tornado.ioloop
 
 from modcommon import json_handler
+from modcommon.pedalboard import hardware_connections
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(index_class, index_path, snapshot=None):
+    """
+    Returns the process-wide instance of index_class for index_path, so that the
+    index is opened only once and its searcher is shared by all requests.
+    snapshot is only used when the index is opened, see Index.
+    Shared indexes are flushed on process exit.
+    """
+    key = os.path.realpath(index_path)
+    with _indexes_lock:
+        try:
+            index = _indexes[key]
+        except KeyError:
+            index = _indexes[key] = index_class(index_path, snapshot)
+            atexit.register(index.flush)
+    if index.__class__ is not index_class:
+        raise Exception("%s is already open as %s" % (index_path, index.__class__.__name__))
+    return index
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+PREDICATE = re.compile(r'^\s*(\w+)\s*(<=|>=|<|>|=|\s+in\s+)\s*(.*?)\s*$')
+RANGES = {
+    # operator: start, end, startexcl, endexcl
+    '<': lambda value: (None, value, False, True),
+    '<=': lambda value: (None, value, False, False),
+    '>': lambda value: (value, None, True, False),
+    '>=': lambda value: (value, None, False, False),
+    }
+
+def words(text):
+    return WORDS.findall(unicode(text).lower())
+
+def number(value):
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError("Not a finite number: %s" % value)
+    if value == int(value):
+        return int(value)
+    return value
+
+def parse_predicate(expression, schema):
+    """
+    Parses a filter like "input_ports<=2" or "stability in (stable, testing)" on an ID,
+    KEYWORD or NUMERIC field of schema. Comparisons other than = and in are only
+    allowed on NUMERIC fields. Returns field, operator and list of values, which are
+    numbers for NUMERIC fields. Fractional bounds of comparisons on integer fields are
+    rounded to the nearest integer inside the range, as whoosh would truncate them.
+    Raises ValueError if expression is not valid.
+    """
+    match = PREDICATE.match(expression)
+    if match is None:
+        raise ValueError("Invalid filter: %s" % expression)
+    field, operator, value = match.group(1), match.group(2).strip(), match.group(3)
+    if field not in schema.names():
+        raise ValueError("Unknown field: %s" % field)
+    kind = schema[field].__class__.__name__
+    if kind not in ('ID', 'KEYWORD', 'NUMERIC'):
+        raise ValueError("Field %s can't be filtered" % field)
+
+    if operator == 'in':
+        if not (value.startswith('(') and value.endswith(')')):
+            raise ValueError("Invalid list: %s" % value)
+        values = [ v.strip().strip('\'"') for v in value[1:-1].split(',') ]
+        values = [ v for v in values if v ]
+    else:
+        values = [ value.strip('\'"') ]
+    if not values:
+        raise ValueError("No values given: %s" % expression)
+
+    if kind == 'NUMERIC':
+        values = [ number(v) for v in values ]
+        numeric = schema[field]
+        if numeric.numtype is int and isinstance(values[0], float) and operator in RANGES:
+            if operator in ('<', '<='):
+                operator, values = '<=', [ int(math.floor(values[0])) ]
+            else:
+                operator, values = '>=', [ int(math.ceil(values[0])) ]
+        if numeric.numtype is int and any([ isinstance(v, float) for v in values ]):
+            raise ValueError("Field %s only has integer values" % field)
+        if any([ v < numeric.min_value or v > numeric.max_value for v in values ]):
+            raise ValueError("Value out of range of field %s" % field)
+    elif operator not in ('=', 'in'):
+        raise ValueError("Field %s is not numeric" % field)
+    else:
+        values = [ unicode(v) for v in values ]
+    return field, operator, values
+
+class PrefixTrie(object):
+    """
+    Autocomplete of documents by the beginning of words in some of their stored fields.
+    Each node of the trie keeps the ids of all documents having a word with that prefix,
+    so a lookup only walks the letters of the typed term.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        # node is [ { char: node }, set of ids ]
+        self.root = [{}, set()]
+        # id => (words, entry)
+        self.entries = {}
+
+    def add(self, data):
+        objid = data['id']
+        if objid in self.entries:
+            self.remove(objid)
+
+        entry = { 'id': objid }
+        doc_words = set()
+        for field in self.fields:
+            value = data.get(field)
+            if value:
+                entry[field] = value
+                # fields like category may be lists of values
+                if isinstance(value, (list, tuple)):
+                    value = u' '.join([ unicode(item) for item in value ])
+                doc_words.update(words(value))
+        entry['score'] = data.get('score', 0)
+        self.entries[objid] = (doc_words, entry)
+
+        for word in doc_words:
+            node = self.root
+            for char in word:
+                node = node[0].setdefault(char, [{}, set()])
+                node[1].add(objid)
+
+    def remove(self, objid):
+        try:
+            doc_words, entry = self.entries.pop(objid)
+        except KeyError:
+            return
+        for word in doc_words:
+            path = [ (None, self.root) ]
+            for char in word:
+                path.append((char, path[-1][1][0][char]))
+            for i in range(len(path) - 1, 0, -1):
+                char, node = path[i]
+                node[1].discard(objid)
+                if not node[1]:
+                    del path[i-1][1][0][char]
+
+    def lookup(self, prefix):
+        node = self.root
+        for char in prefix:
+            try:
+                node = node[0][char]
+            except KeyError:
+                return set()
+        return node[1]
+
+    def search(self, term, limit=10):
+        """
+        Returns entries having words starting with each word of term, highest scores first
+        """
+        term_words = words(term)
+        if not term_words:
+            return []
+        candidates = None
+        for word in sorted(term_words, key=lambda word: len(self.lookup(word))):
+            matches = self.lookup(word)
+            candidates = set(matches) if candidates is None else candidates & matches
+            if not candidates:
+                return []
+
+        def rank(objid):
+            entry = self.entries[objid][1]
+            return (-entry['score'], [ entry.get(field) for field in self.fields ])
+        return [ dict(self.entries[objid][1]) for objid in heapq.nsmallest(limit, candidates, key=rank) ]
+
+# milliseconds
+LATENCY_BOUNDS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SIZE_BOUNDS = (0, 1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram(object):
+    """
+    Counts of values by bucket, each bucket having values up to its bound
+    and greater than previous one. Last bucket has values above all bounds.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, point):
+        """
+        Upper bound of the bucket where percentile point is
+        """
+        rank = point / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def dump(self):
+        result = { 'count': self.count,
+                   'mean': self.total / float(self.count) if self.count else 0,
+                   'max': self.max,
+                   'buckets': [ [bound, count] for bound, count in zip(self.bounds, self.counts) ]
+                              + [ [None, self.counts[-1]] ],
+                   }
+        for point in (50, 90, 99):
+            result['p%d' % point] = self.percentile(point)
+        return result
+
+class Metrics(object):
+    """
+    Latency histograms, in milliseconds, and result size histograms by operation name,
+    and counters. dump() returns all of them as a dictionary that can be encoded as json.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency = {}
+            self.sizes = {}
+            self.counters = {}
+
+    def record(self, name, seconds, size=None):
+        with self.lock:
+            try:
+                latency = self.latency[name]
+            except KeyError:
+                latency = self.latency[name] = Histogram(LATENCY_BOUNDS)
+            latency.add(seconds * 1000)
+            if size is not None:
+                try:
+                    sizes = self.sizes[name]
+                except KeyError:
+                    sizes = self.sizes[name] = Histogram(SIZE_BOUNDS)
+                sizes.add(size)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        yield
+        self.record(name, time.time() - start)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def dump(self):
+        with self.lock:
+            return { 'latency': dict([ (name, h.dump()) for name, h in self.latency.items() ]),
+                     'results': dict([ (name, h.dump()) for name, h in self.sizes.items() ]),
+                     'counters': dict(self.counters),
+                     }
+
+def measured(name):
+    """
+    Decorates an index method so that its duration is recorded in index metrics
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class Fragments(list):
+    """
+    List of json encoded objects, that encode_response() joins without decoding them
+    """
+
+def encode_response(response):
+    if isinstance(response, Fragments):
+        return '[%s]' % ', '.join(response)
+    if isinstance(response, dict) and isinstance(response.get('results'), Fragments):
+        response = dict(response)
+        results = encode_response(response.pop('results'))
+        body = json.dumps(response, default=json_handler)
+        return '%s, "results": %s}' % (body[:-1], results)
+    return json.dumps(response, default=json_handler)
+
+class QueryCache(object):
+    """
+    LRU cache of search results. Keys include the index generation, and the cache
+    is cleared on every commit, so results are never stale.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return { 'size': len(self.entries),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 }
 
 class Index(object):
 
+    # fields that searches can be sorted by
+    sortable_fields = []
+
+    # stored fields that autocomplete looks into
+    autocomplete_fields = []
+
+    # fields that hits can be counted by
+    facet_fields = []
+
+    # number of search results kept in cache
+    cache_size = 256
+
+    # If True, each object is stored encoded as json in the json field, merged with its
+    # stored fields, so that searchers can respond without fetching and encoding objects.
+    # The index must have been created with a schema having the json field.
+    store_json = False
+
+    # Seconds a writer waits for the index lock, when it's held by another process.
+    # Writers of this process wait for each other on _write_lock instead.
+    write_timeout = 10
+
     @property
     def schema(self):
         raise NotImplemented
 
-    def __init__(self, index_path):
+    def __init__(self, index_path, snapshot=None):
+        """
+        snapshot is a package built by modcommon.snapshot, which replaces the index
+        at index_path if it's not installed yet.
+        """
+        self._searcher = None
+        self._searcher_generation = None
+        self._searcher_lock = threading.Lock()
+        # id of searcher => number of searches using it
+        self._searcher_users = {}
+        self._autocomplete = None
+        self._autocomplete_generation = None
+        self._autocomplete_lock = threading.Lock()
+        # held by all writes, so that they don't fail on the index lock of each other
+        self._write_lock = threading.RLock()
+        self.cache = QueryCache(self.cache_size)
+        self.metrics = Metrics()
+        if snapshot is not None:
+            self.adopt(snapshot, index_path)
+        self.open(index_path)
+
+    def adopt(self, snapshot, index_path):
+        from modcommon import snapshot as snapshots
+        snapshots.install(snapshot, index_path)
+
+    def open(self, index_path):
         self.basedir = index_path
         if not os.path.exists(self.basedir):
             os.mkdir(self.basedir)
             self.index = create_in(self.basedir, self.schema)
         else:
             self.index = open_dir(self.basedir)
+            if self.outdated():
+                self.upgrade()
+
+    @property
+    def index_schema(self):
+        """
+        Schema of the index as it was created, which lacks fields added to schema since then.
+        It's read by a searcher, which retries if a commit removes the files it's reading.
+        """
+        with self.searching() as searcher:
+            return searcher.schema
+
+    def has_field(self, name):
+        return name in self.index_schema.names()
+
+    def outdated(self):
+        """
+        Fields of schema that the index doesn't have, as it was created by older code.
+        The json field is only needed if store_json is set.
+        """
+        return sorted([ name for name in self.schema.names()
+                        if not self.has_field(name) and (name != 'json' or self.store_json) ])
+
+    def upgrade(self):
+        """
+        Indexes again, with the current schema, an index created with an older one, if
+        objects are stored in it as json. Otherwise the index is used as it is, new fields
+        are not written and filtering on them is refused, until it's reindexed.
+        """
+        if not self.store_json or not self.has_field('json'):
+            return False
+        with self.index.searcher() as searcher:
+            objects = [ fields.get('json') for fields in searcher.documents() ]
+        if not all(objects):
+            return False
+        self.replace([ json.loads(obj) for obj in objects ])
+        return True
+
+    def reindex(self, objects):
+        """
+        Creates the index again from all objects, with the current schema, and replaces
+        the existing one when it's complete. This is needed when fields are added to the
+        schema of an existing index. Returns number of indexed objects.
+        """
+        with self._write_lock:
+            old_ids = set([ fields['id'] for fields in self.documents() ])
+            documents = self.replace(objects)
+            new_ids = set([ data['id'] for data in documents ])
+            self.committed(documents, deleted=sorted(old_ids - new_ids))
+        return len(documents)
+
+    def replace(self, objects):
+        with self._write_lock:
+            return self._replace(objects)
+
+    def _replace(self, objects):
+        path = os.path.realpath(self.basedir)
+        new_path = path + '.new'
+        old_path = path + '.old'
+        for leftover in (new_path, old_path):
+            if os.path.exists(leftover):
+                shutil.rmtree(leftover)
+
+        os.mkdir(new_path)
+        index = create_in(new_path, self.schema)
+        writer = index.writer()
+        documents = []
+        try:
+            for obj in objects:
+                data = self.prepare(obj, index.schema)
+                writer.add_document(**data)
+                documents.append(data)
+            with self.metrics.timer('commit'):
+                writer.commit(optimize=True)
+        except:
+            writer.cancel()
+            shutil.rmtree(new_path)
+            raise
+
+        with self._searcher_lock:
+            os.rename(path, old_path)
+            os.rename(new_path, path)
+            self.index = open_dir(path)
+            # searches still running keep their searcher, which is closed when they end
+            previous, self._searcher, self._searcher_generation = self._searcher, None, None
+            if previous is not None and id(previous) not in self._searcher_users:
+                previous.close()
+        shutil.rmtree(old_path)
+        return documents
+
+    @property
+    def generation(self):
+        return self.index.latest_generation()
+
+    def searcher(self):
+        """
+        Returns a searcher for the latest generation of the index. The same searcher
+        is returned until the index changes, so it must not be closed. It's closed
+        when it's replaced, so searches should use searching() instead.
+        """
+        with self._searcher_lock:
+            return self._latest_searcher()
+
+    def _latest_searcher(self):
+        generation = self.generation
+        if self._searcher is None or self._searcher_generation != generation:
+            previous = self._searcher
+            self._searcher = self.index.searcher()
+            self._searcher_generation = generation
+            # Previous searcher may still be in use by a running search,
+            # in which case it's closed when that search releases it
+            if previous is not None and id(previous) not in self._searcher_users:
+                previous.close()
+        return self._searcher
+
+    @contextmanager
+    def searching(self):
+        """
+        Searcher for the latest generation of the index, which is kept open until
+        the block ends, even if the index changes meanwhile
+        """
+        with self._searcher_lock:
+            searcher = self._latest_searcher()
+            key = id(searcher)
+            self._searcher_users[key] = self._searcher_users.get(key, 0) + 1
+        try:
+            yield searcher
+        finally:
+            with self._searcher_lock:
+                self._searcher_users[key] -= 1
+                if not self._searcher_users[key]:
+                    del self._searcher_users[key]
+                    if searcher is not self._searcher:
+                        searcher.close()
+
+    def documents(self):
+        """
+        Stored fields of all documents
+        """
+        with self.searching() as searcher:
+            for fields in searcher.documents():
+                fields.pop('json', None)
+                yield fields
+
+    def stored(self, objid):
+        """
+        Stored fields of document with given id, or None
+        """
+        with self.searching() as searcher:
+            fields = searcher.document(id=unicode(objid))
+        if fields is not None:
+            fields.pop('json', None)
+        return fields
+
+    def copies(self, results, raw=False):
+        """
+        Copies of cached stored fields. The json field is only kept if raw is True.
+        """
+        if raw:
+            return [ dict(fields) for fields in results ]
+        return [ dict([ (key, value) for key, value in fields.items() if key != 'json' ])
+                 for fields in results ]
 
     def schemed_data(self, obj):
         data = {}
@@ -32,53 +580,340 @@ class Index(object):
             if key == 'id':
                 data['id'] = unicode(obj['_id'])
                 continue
+            if key == 'json':
+                continue
             try:
                 data[key] = obj[key]
             except KeyError:
                 data[key] = u''
         return data
 
-    def find(self, **kwargs):
-        terms = []
-        for key, value in kwargs.items():
-            terms.append(Term(key, value))
+    def results(self, searcher, query, page=None, pagelen=20, limit=None, sortedby=None, reverse=False):
+        """
+        Runs whoosh query in searcher, which must be kept open while results are read.
+        If page is given, only that page of pagelen hits is scored and returned,
+        otherwise at most limit hits (all of them if limit is None).
+        sortedby is a field name, results are sorted by score if it's None.
+        """
+        if page is None:
+            return searcher.search(query, limit=limit, sortedby=sortedby, reverse=reverse)
+        return searcher.search_page(query, page, pagelen=pagelen, sortedby=sortedby, reverse=reverse)
 
-        with self.index.searcher() as searcher:
-            for entry in searcher.search(And(terms), limit=None):
-                yield entry.fields()
+    def hits(self, query, page=None, pagelen=20, limit=None, sortedby=None, reverse=False, raw=False):
+        """
+        Returns stored fields of hits of whoosh query, as results() would find them.
+        Results are cached until the index changes, and copies are returned.
+        """
+        key = (query.normalize(), page, pagelen, limit, sortedby, reverse, self.generation)
+        def compute():
+            with self.searching() as searcher:
+                results = self.results(searcher, query, page, pagelen, limit, sortedby, reverse)
+                return [ entry.fields() for entry in results ]
+        return self.copies(self.cache.get(key, compute), raw)
 
-    def every(self):
-        with self.index.searcher() as searcher:
-            for entry in searcher.search(Every(), limit=None):
-                yield entry.fields()
+    def paginate(self, query, page=1, pagelen=20, sortedby=None, reverse=False, raw=False):
+        """
+        Returns one page of hits of whoosh query, with total number of hits
+        """
+        key = ('page', query.normalize(), page, pagelen, sortedby, reverse, self.generation)
+        def compute():
+            with self.searching() as searcher:
+                results = self.results(searcher, query, page, pagelen, sortedby=sortedby, reverse=reverse)
+                return { 'total': results.total,
+                         'page': results.pagenum,
+                         'pagecount': results.pagecount,
+                         'pagelen': pagelen,
+                         'results': [ entry.fields() for entry in results ],
+                         }
+        result = dict(self.cache.get(key, compute))
+        result['results'] = self.copies(result['results'], raw)
+        return result
 
-    def term_search(self, query):
+    def facets(self, query, fields):
+        """
+        Counts hits of whoosh query by each value of fields, in a single search.
+        Returns total number of hits and, for each field, a list of [ value, count ]
+        with most common values first.
+        """
+        fields = sorted(fields)
+        key = ('facets', query.normalize(), tuple(fields), self.generation)
+        def compute():
+            groupedby = dict([ (field, sorting.FieldFacet(field)) for field in fields ])
+            with self.searching() as searcher:
+                results = searcher.search(query, limit=1, groupedby=groupedby, maptype=sorting.Count)
+                counts = {}
+                for field in fields:
+                    groups = [ [value, count] for value, count in results.groups(field).items()
+                               if value not in (u'', None) ]
+                    counts[field] = sorted(groups, key=lambda group: (-group[1], group[0]))
+                return { 'total': len(results), 'facets': counts }
+        result = self.cache.get(key, compute)
+        return { 'total': result['total'],
+                 'facets': dict([ (field, [ list(group) for group in groups ])
+                                  for field, groups in result['facets'].items() ]),
+                 }
+
+    def find_query(self, **kwargs):
+        terms = []
+        for key, value in sorted(kwargs.items()):
+            terms.append(Term(key, value))
+        return And(terms)
+
+    def term_query(self, query):
         terms = []
         if query.get('term'):
-            parser = MultifieldParser(self.term_fields, schema=self.index.schema)
-            terms.append(parser.parse(unicode(query.pop('term')[0])))
-        for key in query.keys():
-            terms.append(Or([ Term(key, unicode(t)) for t in query.pop(key) ]))
-        with self.index.searcher() as searcher:
-            for entry in searcher.search(And(terms), limit=None):
-                yield entry.fields()
+            parser = MultifieldParser(self.term_fields, schema=self.index_schema)
+            terms.append(parser.parse(unicode(query['term'][0])))
+        for key, values in sorted(query.items()):
+            if key == 'term':
+                continue
+            if key == 'where':
+                for expression in sorted(values):
+                    terms.append(self.predicate_query(*parse_predicate(expression, self.index_schema)))
+                continue
+            if key in self.schema.names() and not self.has_field(key):
+                raise ValueError("Field %s is not in index yet, it must be reindexed" % key)
+            terms.append(Or([ Term(key, unicode(t)) for t in sorted(values) ]))
+        return And(terms)
+
+    def predicate_query(self, field, operator, values):
+        if operator in RANGES:
+            start, end, startexcl, endexcl = RANGES[operator](values[0])
+            return NumericRange(field, start, end, startexcl, endexcl)
+        if isinstance(values[0], basestring):
+            return Or([ Term(field, value) for value in sorted(values) ])
+        return Or([ NumericRange(field, value, value) for value in sorted(values) ])
+
+    def measured_hits(self, name, query, *args):
+        start = time.time()
+        results = self.hits(query, *args)
+        self.metrics.record(name, time.time() - start, len(results))
+        return iter(results)
+
+    def find(self, page=None, pagelen=20, limit=None, sortedby=None, reverse=False, **kwargs):
+        query = self.find_query(**kwargs)
+        return self.measured_hits('find', query, page, pagelen, limit, sortedby, reverse)
+
+    def every_query(self):
+        return Every()
+
+    def every(self, page=None, pagelen=20, limit=None, sortedby=None, reverse=False):
+        return self.measured_hits('every', self.every_query(), page, pagelen, limit, sortedby, reverse)
+
+    def term_search(self, query, page=None, pagelen=20, limit=None, sortedby=None, reverse=False):
+        query = self.term_query(query)
+        return self.measured_hits('term_search', query, page, pagelen, limit, sortedby, reverse)
+
+    def document(self, obj):
+        return self.schemed_data(obj)
 
+    def prepare(self, obj, schema=None):
+        """
+        Document to be written for obj, with obj encoded as json if store_json is set.
+        Only fields of schema are written, index_schema by default.
+        """
+        names = (schema or self.index_schema).names()
+        data = dict([ (key, value) for key, value in self.document(obj).items() if key in names ])
+        if self.store_json and 'json' in names:
+            entry = {}
+            for key in self.schema.stored_names():
+                if key in data and key != 'json':
+                    entry[key] = data[key]
+            entry.update(obj)
+            data['json'] = json.dumps(entry, default=json_handler)
+        return data
+
+    def writer(self, **kwargs):
+        """
+        Whoosh writer of the index, which must be used while holding _write_lock
+        """
+        return self.index.writer(timeout=self.write_timeout, **kwargs)
+
+    @measured('add')
     def add(self, obj):
-        data = self.schemed_data(obj)
+        data = self.prepare(obj)
+
+        with self._write_lock:
+            writer = self.writer()
+            writer.update_document(**data)
+            with self.metrics.timer('commit'):
+                writer.commit()
+            self.committed([data])
+
+    @measured('add_many')
+    def add_many(self, objs, limitmb=128, procs=1, multisegment=False,
+                 merge=True, optimize=False, update=True):
+        """
+        Indexes all objects from an iterable, like bundle.data['plugins'].values() or a
+        whole catalog, with a single writer and a single commit.
+
+        limitmb is the memory used by each writer before flushing to disk. With procs > 1,
+        whoosh's multiprocessing writer is used, and if multisegment is True the segment
+        created by each process is kept as is, instead of being merged.
+        merge and optimize are passed to commit. If update is False documents are just added,
+        which is faster when building an index from scratch.
 
-        writer = self.index.writer()
-        writer.update_document(**data)
-        writer.commit()
+        Returns number of indexed objects.
+        """
+        kwargs = { 'limitmb': limitmb }
+        if procs > 1:
+            kwargs['procs'] = procs
+            kwargs['multisegment'] = multisegment
 
+        with self._write_lock:
+            writer = self.writer(**kwargs)
+            documents = []
+            try:
+                for obj in objs:
+                    data = self.prepare(obj)
+                    if update:
+                        writer.update_document(**data)
+                    else:
+                        writer.add_document(**data)
+                    documents.append(data)
+            except:
+                writer.cancel()
+                raise
+            with self.metrics.timer('commit'):
+                writer.commit(merge=merge, optimize=optimize)
+            self.committed(documents)
+        return len(documents)
+
+    @measured('delete')
     def delete(self, objid):
-        writer = self.index.writer()
-        count = writer.delete_by_term('id', objid)
-        writer.commit()
+        with self._write_lock:
+            writer = self.writer()
+            count = writer.delete_by_term('id', objid)
+            with self.metrics.timer('commit'):
+                writer.commit()
+            self.committed(deleted=[objid])
         return count > 0
 
+    @measured('delete_many')
+    def delete_many(self, objids):
+        """
+        Deletes documents with a single writer. Returns number of deleted documents.
+        """
+        objids = [ unicode(objid) for objid in objids ]
+        if not objids:
+            return 0
+        with self._write_lock:
+            writer = self.writer()
+            count = 0
+            try:
+                for objid in objids:
+                    count += writer.delete_by_term('id', objid)
+            except:
+                writer.cancel()
+                raise
+            with self.metrics.timer('commit'):
+                writer.commit()
+            self.committed(deleted=objids)
+        return count
+
+    def stats(self):
+        """
+        Number of documents, deleted documents not discarded yet and segments, and size
+        of index files in bytes
+        """
+        files = [ os.path.join(self.basedir, name) for name in os.listdir(self.basedir) ]
+        with self.searching() as searcher:
+            reader = searcher.reader()
+            documents = reader.doc_count()
+            deleted = reader.doc_count_all() - documents
+            segments = len(reader.leaf_readers())
+        return { 'documents': documents,
+                 'segments': segments,
+                 'deleted': deleted,
+                 'outdated': self.outdated(),
+                 'size': sum([ os.path.getsize(path) for path in files if os.path.isfile(path) ]),
+                 'generation': self.generation,
+                 }
+
+    def optimize(self):
+        """
+        Merges all segments into one, and discards deleted documents
+        """
+        with self._write_lock:
+            self.writer().commit(optimize=True)
+            self.committed()
 
+    def autocomplete(self, term, limit=10):
+        """
+        Returns up to limit entries with words starting with each word of term, ranked
+        by score. The prefix trie is built from the index on first use, and built again
+        if the index was changed by another process.
+        """
+        with self._autocomplete_lock:
+            generation = self.generation
+            if self._autocomplete is None or self._autocomplete_generation != generation:
+                trie = PrefixTrie(self.autocomplete_fields)
+                for fields in self.documents():
+                    trie.add(fields)
+                self._autocomplete = trie
+                self._autocomplete_generation = generation
+            return self._autocomplete.search(term, limit)
+
+    def flush(self):
+        """
+        Writes changes kept in memory to index
+        """
+
+    def committed(self, documents=(), deleted=()):
+        """
+        Called after each commit with the documents written and the ids deleted, so that
+        in-memory structures are kept in sync with the index.
+        """
+        self.cache.clear()
+        with self._autocomplete_lock:
+            if self._autocomplete is not None:
+                for data in documents:
+                    self._autocomplete.add(data)
+                for objid in deleted:
+                    self._autocomplete.remove(objid)
+                self._autocomplete_generation = self.next_generation(self._autocomplete_generation)
+
+    def next_generation(self, generation):
+        """
+        Generation of an in-memory structure that was at generation and has been updated
+        with a commit of this process. That's the current one, unless another process
+        committed too, in which case it's None, so that the structure is built again.
+        """
+        current = self.generation
+        if generation is not None and current == generation + 1:
+            return current
+        return None
+
+
+
+_executor = None
+_semaphore = None
+
+def setup_executor(workers=4, concurrency=8):
+    """
+    Configures the thread pool in which searchers run index work: workers is the number
+    of threads, and concurrency the number of requests being handled at once, others
+    waiting for their turn without taking a thread. Must be called before the IOLoop starts
+    serving, otherwise defaults are used.
+    """
+    global _executor, _semaphore
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=workers)
+    _semaphore = tornado.locks.Semaphore(concurrency)
+
+def get_executor():
+    if _executor is None:
+        setup_executor()
+    return _executor, _semaphore
 
 class Searcher(tornado.web.RequestHandler):
+
+    max_pagelen = 100
+
+    # responses larger than this are compressed, if client accepts it
+    gzip_min_length = 1024
+
     @classmethod
     def urls(cls, path):
         return [
@@ -86,20 +921,65 @@ class Searcher(tornado.web.RequestHandler):
             (r"/%s/(search)/?" % path, cls),
             (r"/%s/(get)/([a-z0-9]+)?" % path, cls),
             (r"/%s/(list)/?" % path, cls),
+            (r"/%s/(metrics)/?" % path, cls),
             ]
 
+    # must be set to subclass of Index
+    index_class = Index
+
     @property
     def index_path(self):
         raise NotImplemented
 
     @property
     def index(self):
-        # must be implemented to return subclass of Index
-        return Index(self.index_path)
+        return get_index(self.index_class, self.index_path)
 
     def get_object(self, objid):
         raise NotImplemented
 
+    def get_objects(self, objids):
+        """
+        Returns a dictionary of id => object for all given ids, missing objects
+        being left out. Subclasses should override this to fetch all objects at once,
+        as by default get_object is called for each id.
+        """
+        objects = {}
+        for objid in objids:
+            obj = self.get_object(objid)
+            if obj is not None:
+                objects[objid] = obj
+        return objects
+
+    def merge_objects(self, entries):
+        """
+        Updates index entries with full objects, skipping entries without object
+        """
+        entries = list(entries)
+        objects = self.get_objects([ entry['id'] for entry in entries ])
+        result = []
+        for entry in entries:
+            obj = objects.get(entry['id'])
+            if obj is None:
+                # TODO isso acontece qdo sobra lixo no índice, não deve acontecer na produção
+                continue
+            entry.update(obj)
+            result.append(entry)
+        return result
+
+    def initialize(self):
+        self.closed = False
+        self.future = None
+        self.etag = None
+        self.action = None
+
+    def on_connection_close(self):
+        # request is dropped if it's still waiting, but work already started runs to the end
+        self.closed = True
+        if self.future is not None:
+            self.future.cancel()
+
+    @tornado.gen.coroutine
     def get(self, action, objid=None):
         try:
             self.set_header('Access-Control-Allow-Origin', self.request.headers['Origin'])
@@ -107,7 +987,92 @@ class Searcher(tornado.web.RequestHandler):
             pass
 
         self.set_header('Content-type', 'application/json')
+        # any response may be compressed
+        self.set_header('Vary', 'Accept-Encoding')
+        self.action = action
+
+        # responses that depend only on index and request can be validated without searching
+        if self.cacheable(action):
+            self.etag = self.index_etag(action)
+            self.set_etag_header()
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+
+        executor, semaphore = get_executor()
+        yield semaphore.acquire()
+        try:
+            if self.closed:
+                return
+            self.future = executor.submit(self.encoded_response, action, objid)
+            try:
+                body, gzipped = yield self.future
+            except CancelledError:
+                return
+        finally:
+            semaphore.release()
+
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+        self.write(body)
+
+    def on_finish(self):
+        if self.action is not None:
+            metrics = self.index.metrics
+            metrics.record('action.%s' % self.action, self.request.request_time())
+            metrics.count('status.%d' % self.get_status())
 
+    def objects_version(self):
+        """
+        Version of the objects that search and list merge into their responses, like
+        the time of the last change in database, or None if it's not known. Subclasses
+        that return it get ETags for those responses.
+        """
+        return None
+
+    def cacheable(self, action):
+        """
+        Whether response of action depends only on index, request and objects_version(),
+        so that it can have an ETag
+        """
+        if action in ('autocomplete', 'facets'):
+            return True
+        if action in ('search', 'list'):
+            # objects are stored in index only if it was created with the json field
+            stored = self.index.store_json and self.index.has_field('json')
+            return stored or self.objects_version() is not None
+        return False
+
+    def index_etag(self, action):
+        arguments = sorted(self.request.arguments.items())
+        key = repr((self.index.__class__.__name__, self.index.generation, self.objects_version(),
+                    action, arguments))
+        return '"%s"' % hashlib.md5(key).hexdigest()
+
+    def compute_etag(self):
+        return self.etag
+
+    def accepts_gzip(self):
+        return 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+    def encoded_response(self, action, objid=None):
+        """
+        Runs in executor. Returns response body, compressed if it's large and client
+        accepts it, and whether it's compressed
+        """
+        body = self.respond(action, objid)
+        if len(body) < self.gzip_min_length or not self.accepts_gzip():
+            return body, False
+        buf = StringIO()
+        fh = gzip.GzipFile(mode='w', fileobj=buf, compresslevel=6)
+        fh.write(body)
+        fh.close()
+        return buf.getvalue(), True
+
+    def respond(self, action, objid=None):
+        """
+        Runs in executor, so it must not touch the response. Returns response body.
+        """
         if action == 'autocomplete':
             response = self.autocomplete()
         if action == 'search':
@@ -121,33 +1086,316 @@ class Searcher(tornado.web.RequestHandler):
         if action == 'list':
             response = self.list()
 
-        self.write(json.dumps(response, default=json_handler))
+        if action == 'metrics':
+            response = self.metrics()
+
+        return encode_response(response)
+
+    def metrics(self):
+        return { 'index': self.index.stats(),
+                 'cache': self.index.cache.stats(),
+                 'metrics': self.index.metrics.dump(),
+                 }
 
     def autocomplete(self):
-        term = unicode(self.request.arguments.get('term')[0])
-        result = []
-        for entry in self.index.term_search(term):
-            result.append(entry)
-        return result
+        term = self.get_argument('term')
+        try:
+            limit = int(self.get_argument('limit', 10))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if limit < 1:
+            raise tornado.web.HTTPError(400)
+        return self.index.autocomplete(term, min(limit, self.max_pagelen))
+
+    def search_options(self):
+        """
+        Removes paging and sorting arguments from request, so that remaining ones are
+        search filters, and returns them as keyword arguments for index searches:
+        page and pagelen (for paged results), limit (for top results),
+        sort (a field in index's sortable_fields) and reverse.
+        """
+        arguments = self.request.arguments
+        options = {}
+        try:
+            for key in ('page', 'pagelen', 'limit'):
+                if key in arguments:
+                    options[key] = int(arguments.pop(key)[0])
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        if options.get('page', 1) < 1 or options.get('pagelen', 1) < 1 or options.get('limit', 1) < 1:
+            raise tornado.web.HTTPError(400)
+        options['pagelen'] = min(options.get('pagelen', 20), self.max_pagelen)
+
+        if 'sort' in arguments:
+            sortedby = arguments.pop('sort')[0]
+            if sortedby not in self.index.sortable_fields or not self.index.has_field(sortedby):
+                raise tornado.web.HTTPError(400)
+            options['sortedby'] = sortedby
+        if 'reverse' in arguments:
+            options['reverse'] = arguments.pop('reverse')[0] in ('1', 'true')
+        return options
+
+    def paginated(self, query, options):
+        """
+        Runs whoosh query as requested by search options. Returns a page, with hits and
+        totals, if a page was requested, the top hits with total if a limit was, or a
+        plain list of all hits otherwise, as before paging existed.
+        """
+        if options.get('page'):
+            options.pop('limit', None)
+            page = self.index.paginate(query, raw=True, **options)
+            page['results'] = self.encoded_objects(page['results'])
+            return page
+        options.pop('pagelen')
+        if options.get('limit'):
+            # top hits are the first page of limit hits, which has the total
+            limit = options.pop('limit')
+            page = self.index.paginate(query, page=1, pagelen=limit, raw=True, **options)
+            return { 'total': page['total'],
+                     'limit': limit,
+                     'results': self.encoded_objects(page['results']),
+                     }
+        return self.encoded_objects(self.index.hits(query, raw=True, **options))
+
+    def encoded_objects(self, entries):
+        """
+        Objects of entries as stored in index json field, if all of them have it,
+        or entries merged with objects otherwise
+        """
+        if entries and all([ entry.get('json') for entry in entries ]):
+            return Fragments([ entry['json'] for entry in entries ])
+        for entry in entries:
+            entry.pop('json', None)
+        return self.merge_objects(entries)
+
+    def query(self):
+        """
+        Query for term, filters and where arguments of request. Filters by where
+        arguments are predicates on fields, like where=input_ports<=2
+        """
+        try:
+            return self.index.term_query(self.request.arguments)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
 
     def search(self):
-        result = []
-        for entry in self.index.term_search(self.request.arguments):
-            obj = self.get_object(entry['id'])
-            if obj is None:
-                # TODO isso acontece qdo sobra lixo no índice, não deve acontecer na produção
-                continue 
-            entry.update(obj)
-            result.append(entry)
-        return result
+        options = self.search_options()
+        return self.paginated(self.query(), options)
 
     def list(self):
-        # TODO isso soh serve pro desenvolvimento, pro cloud é inviável
-        result = []
-        for entry in self.index.every():
-            entry.update(self.get_object(entry['id']))
-            result.append(entry)
-        return result
+        # TODO sem page ou limit isso soh serve pro desenvolvimento, pro cloud é inviável
+        options = self.search_options()
+        return self.paginated(self.index.every_query(), options)
+
+class ScoreCounter(object):
+    """
+    Accumulates score increments of effects in memory, and writes them to index
+    in a single writer transaction: when flush_interval seconds have passed since last
+    flush or when max_pending effects are waiting, in the searchers' executor, and
+    periodically if start() is called. Shared indexes are also flushed on process exit.
+
+    Increments are added to the score stored in index at flush time, so concurrent
+    requests scoring the same effect don't overwrite each other.
+    """
+
+    def __init__(self, index, flush_interval=60, max_pending=100):
+        self.index = index
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # id => [ increment, latest effect data ]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.time()
+        self.callback = None
+        # future of flush running in executor
+        self.scheduled = None
+
+    def increment(self, effect, amount=1):
+        objid = unicode(effect['_id'])
+        with self.lock:
+            try:
+                self.pending[objid][0] += amount
+                self.pending[objid][1] = effect
+            except KeyError:
+                self.pending[objid] = [amount, effect]
+            due = (len(self.pending) >= self.max_pending or
+                   time.time() - self.last_flush >= self.flush_interval)
+        if due:
+            self.schedule()
+
+    def schedule(self):
+        """
+        Flushes in the searchers' executor, so that requests don't wait for the commit,
+        unless a flush is already scheduled. Returns its future.
+        """
+        with self.lock:
+            if self.scheduled is None or self.scheduled.done():
+                self.scheduled = get_executor()[0].submit(self.flush)
+            return self.scheduled
+
+    def start(self):
+        """
+        Flushes every flush_interval seconds, scheduled by tornado's IOLoop
+        """
+        self.callback = tornado.ioloop.PeriodicCallback(self.schedule, self.flush_interval * 1000)
+        self.callback.start()
+
+    def stop(self):
+        if self.callback:
+            self.callback.stop()
+            self.callback = None
+
+    def flush(self):
+        """
+        Writes pending increments to index. Returns number of updated effects.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.last_flush = time.time()
+            if not pending:
+                return 0
+
+            effects = []
+            for objid, (amount, effect) in pending.items():
+                stored = self.index.stored(objid) or {}
+                effect = dict(effect)
+                effect['score'] = stored.get('score', 0) + amount
+                effects.append(effect)
+            try:
+                self.index.add_many(effects)
+            except:
+                # Increments are not lost, they'll be written on next flush
+                with self.lock:
+                    for objid, (amount, effect) in pending.items():
+                        if objid in self.pending:
+                            self.pending[objid][0] += amount
+                        else:
+                            self.pending[objid] = [amount, effect]
+                raise
+            return len(effects)
+
+class Maintenance(object):
+    """
+    Keeps index clean: purges documents whose objects don't exist anymore, which
+    searches would skip anyway, and optimizes index when it has more than
+    max_segments segments, as each commit creates a new one, or when more than
+    max_deleted of its documents are deleted ones, which still take space and time.
+
+    get_objects is a function that returns a dictionary of id => object for the
+    given ids, like Searcher.get_objects. Ids are checked in batches of batch_size.
+    If more than max_purge of all documents seem to be orphans, as when the database
+    is unavailable and returns nothing, nothing is purged and the report tells so.
+    """
+
+    def __init__(self, index, get_objects, max_segments=10, batch_size=500, max_purge=0.25,
+                 max_deleted=0.2):
+        self.index = index
+        self.get_objects = get_objects
+        self.max_segments = max_segments
+        self.max_deleted = max_deleted
+        self.batch_size = batch_size
+        self.max_purge = max_purge
+        self.lock = threading.Lock()
+        self.callback = None
+        self.last_report = None
+
+    def orphans(self):
+        orphans = []
+        ids = [ fields['id'] for fields in self.index.documents() ]
+        for i in range(0, len(ids), self.batch_size):
+            batch = ids[i:i+self.batch_size]
+            objects = self.get_objects(batch)
+            orphans.extend([ objid for objid in batch if objects.get(objid) is None ])
+        return orphans
+
+    def run(self):
+        """
+        Runs maintenance and returns a report, with index stats before and after it
+        """
+        with self.lock:
+            start = time.time()
+            report = { 'before': self.index.stats() }
+            orphans = self.orphans()
+            report['orphans'] = len(orphans)
+            report['purge_aborted'] = len(orphans) > self.max_purge * report['before']['documents']
+            if report['purge_aborted']:
+                report['purged'] = 0
+            else:
+                report['purged'] = self.index.delete_many(orphans)
+            report['optimized'] = self.needs_optimize(self.index.stats())
+            if report['optimized']:
+                self.index.optimize()
+            report['after'] = self.index.stats()
+            report['duration'] = time.time() - start
+            self.last_report = report
+            return report
+
+    def needs_optimize(self, stats):
+        if stats['segments'] > self.max_segments:
+            return True
+        total = stats['documents'] + stats['deleted']
+        return total > 0 and stats['deleted'] > self.max_deleted * total
+
+    def start(self, interval=3600):
+        """
+        Runs maintenance every interval seconds, in the searchers' executor
+        """
+        def run():
+            if not self.lock.locked():
+                get_executor()[0].submit(self.run)
+        self.callback = tornado.ioloop.PeriodicCallback(run, interval * 1000)
+        self.callback.start()
+
+    def stop(self):
+        if self.callback:
+            self.callback.stop()
+            self.callback = None
+
+class TopScores(object):
+    """
+    The capacity highest scoring documents, kept in memory. All documents with a positive
+    score are kept in a map of id => (score, stored fields), and the top ones are
+    recalculated only when a change can affect them.
+    """
+
+    def __init__(self, documents, capacity=100):
+        self.capacity = capacity
+        self.entries = {}
+        for fields in documents:
+            self.entries[fields['id']] = (fields['score'], fields)
+        self.rank()
+
+    def rank(self):
+        self.top = heapq.nlargest(self.capacity, self.entries.values(), key=lambda entry: entry[0])
+
+    def update(self, documents=(), deleted=()):
+        changed = False
+        lowest = self.top[-1][0] if len(self.top) >= self.capacity else 0
+        top_ids = set([ fields['id'] for score, fields in self.top ])
+
+        for fields in documents:
+            objid = fields['id']
+            if fields.get('score', 0) > 0:
+                self.entries[objid] = (fields['score'], fields)
+            else:
+                self.entries.pop(objid, None)
+            changed = changed or objid in top_ids or fields.get('score', 0) > lowest
+        for objid in deleted:
+            self.entries.pop(objid, None)
+            changed = changed or objid in top_ids
+
+        if changed:
+            self.rank()
+
+    def get(self, limit):
+        if limit > self.capacity:
+            top = heapq.nlargest(limit, self.entries.values(), key=lambda entry: entry[0])
+        else:
+            top = self.top[:limit]
+        return [ dict(fields) for score, fields in top ]
 
 class EffectIndex(Index):
     
@@ -169,11 +1417,53 @@ class EffectIndex(Index):
                     smallLabel=STORED(),
                     brand=ID(stored=True),
                     score=NUMERIC(stored=True),
+                    json=STORED(),
                     )
 
     term_fields = ['label', 'name', 'category', 'author', 'description']
+    autocomplete_fields = ['name', 'label', 'brand', 'category']
+    facet_fields = ['category', 'stability', 'brand', 'input_ports', 'output_ports']
+    sortable_fields = ['score', 'input_ports', 'output_ports', 'category', 'brand', 'stability', 'package']
+
+    # number of favorites kept in memory
+    favorites_capacity = 100
+
+    def __init__(self, index_path, snapshot=None):
+        super(EffectIndex, self).__init__(index_path, snapshot)
+        self.scores = ScoreCounter(self)
+        self._favorites = None
+        self._favorites_generation = None
+        self._favorites_lock = threading.Lock()
+
+    def flush(self):
+        self.scores.flush()
+        super(EffectIndex, self).flush()
+
+    def favorites(self, limit=15):
+        """
+        Returns the limit effects with highest score, as stored fields. Effects that were never
+        scored are left out. They are kept in memory, and read again from the index if it was
+        changed by another process.
+        """
+        with self._favorites_lock:
+            generation = self.generation
+            if self._favorites is None or self._favorites_generation != generation:
+                documents = [ fields for fields in self.documents() if fields.get('score', 0) > 0 ]
+                self._favorites = TopScores(documents, self.favorites_capacity)
+                self._favorites_generation = generation
+            return self._favorites.get(limit)
 
-    def add(self, effect):
+    def committed(self, documents=(), deleted=()):
+        super(EffectIndex, self).committed(documents, deleted)
+        stored = self.schema.stored_names()
+        documents = [ dict([ (key, value) for key, value in data.items() if key in stored and key != 'json' ])
+                      for data in documents ]
+        with self._favorites_lock:
+            if self._favorites is not None:
+                self._favorites.update(documents, deleted)
+                self._favorites_generation = self.next_generation(self._favorites_generation)
+
+    def document(self, effect):
         effect['score'] = effect.get('score', 0)
         effect_data = self.schemed_data(effect)
             
@@ -182,12 +1472,18 @@ class EffectIndex(Index):
 
         effect_data['score'] = effect_data.get('score', 0)
 
-        writer = self.index.writer()
-        writer.update_document(**effect_data)
-        writer.commit()
+        return effect_data
 
 class EffectSearcher(Searcher):
 
+    index_class = EffectIndex
+
+    @classmethod
+    def urls(cls, path):
+        return super(EffectSearcher, cls).urls(path) + [
+            (r"/%s/(facets)/?" % path, cls),
+            ]
+
     def get_by_url(self):
         try:
             url = self.request.arguments['url'][0]
@@ -202,43 +1498,81 @@ class EffectSearcher(Searcher):
 
         return entry['id']
 
-    def get(self, action, objid=None):
+    def respond(self, action, objid=None):
         if action == 'get' and objid is None:
             objid = self.get_by_url()
 
-        super(EffectSearcher, self).get(action, objid)
+        if action == 'facets':
+            return json.dumps(self.facets())
+
+        return super(EffectSearcher, self).respond(action, objid)
+
+    def facets(self):
+        """
+        Counts effects matching term and filters by each facet argument,
+        or by all index's facet_fields if none is given
+        """
+        fields = self.request.arguments.pop('facet', None) or self.index.facet_fields
+        if any([ field not in self.index.facet_fields or not self.index.has_field(field) for field in fields ]):
+            raise tornado.web.HTTPError(400)
+        # paging makes no sense here
+        self.search_options()
+        if self.request.arguments:
+            query = self.query()
+        else:
+            query = self.index.every_query()
+        return self.index.facets(query, fields)
 
     def score(self, effect):
         effect['score'] = effect.get('score', 0) + 1
-        self.index.add(effect)
+        self.index.scores.increment(effect)
 
     def favorites(self, limit=15):
-        score = sorting.FieldFacet("score", reverse=True)
-        with self.index.index.searcher() as searcher:
-            for entry in searcher.search(Every(), limit=limit, sortedby=score):
-                effect = entry.fields()
-                if not effect.get('score'):
-                    return                
-                yield entry.fields()
-
-    
-    @property
-    def index(self):
-        return EffectIndex(self.index_path)
+        for effect in self.index.favorites(limit):
+            yield effect
 
 class PedalboardIndex(Index):
 
     schema = Schema(id=ID(unique=True, stored=True),
                     title=NGRAMWORDS(minsize=3, maxsize=5, stored=True),
                     description=TEXT,
+                    # hardware requirements, as counted by pedalboard.hardware_connections
+                    audio_inputs=NUMERIC,
+                    audio_outputs=NUMERIC,
+                    midi_inputs=NUMERIC,
+                    midi_outputs=NUMERIC,
+                    footswitch_addressings=NUMERIC,
+                    rotary_addressings=NUMERIC,
+                    pedal_addressings=NUMERIC,
+                    # urls of plugins of all instances
+                    plugins=KEYWORD(commas=True),
+                    json=STORED(),
                     )
 
     term_fields = ['title', 'description']
+    autocomplete_fields = ['title']
+    sortable_fields = ['audio_inputs', 'audio_outputs', 'midi_inputs', 'midi_outputs',
+                       'footswitch_addressings', 'rotary_addressings', 'pedal_addressings']
+
+    def document(self, pedalboard):
+        pedalboard_data = self.schemed_data(pedalboard)
+
+        instances = pedalboard.get('instances', [])
+        connections = { 'connections': pedalboard.get('connections', []), 'instances': instances }
+        pedalboard_data.update(hardware_connections(connections))
+
+        urls = set([ instance['url'] for instance in instances if instance.get('url') ])
+        pedalboard_data['plugins'] = u','.join(sorted(urls))
+
+        return pedalboard_data
 
 class PedalboardSearcher(Searcher):
-    @property
-    def index(self):
-        return PedalboardIndex(self.index_path)
+    """
+    Pedalboards can be filtered by plugins they use and by hardware they require, like
+    search?plugins=<url>&where=footswitch_addressings<=2&where=audio_inputs<=2
+    """
+
+    index_class = PedalboardIndex
 
     
 
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import ctypes
+import os, sys, json, time, ctypes, select, tempfile, subprocess, multiprocessing
 from math import exp, log, sqrt
 from hashlib import sha1
 
+from modcommon.dsp import float_pointer
+
 LADSPA_PORT_INPUT   = 0x1
 LADSPA_PORT_OUTPUT  = 0x2
 LADSPA_PORT_CONTROL = 0x4
@@ -29,18 +31,35 @@ LADSPA_HINT_DEFAULT_440     = 0x2C0
 
 
 class LadspaDescriptor(ctypes.Structure):
-    _fields_ = [("UniqueID", ctypes.c_ulong),
-                ("Label", ctypes.c_char_p),
-                ("Properties", ctypes.c_int),
-                ("Name", ctypes.c_char_p),
-                ("Maker", ctypes.c_char_p),
-                ("Copyright", ctypes.c_char_p),
-                ("PortCount", ctypes.c_ulong),
-                ("PortDescriptors", ctypes.c_void_p),
-                ("PortNames", ctypes.c_void_p),
-                ("PortRangeHints", ctypes.c_void_p),
-                # The rest is not useful and has been trimmed
-                ]
+    pass
+
+# Function pointers of the descriptor, which take the descriptor itself as argument
+LADSPA_INSTANTIATE = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.POINTER(LadspaDescriptor), ctypes.c_ulong)
+LADSPA_CONNECT_PORT = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_float))
+LADSPA_HANDLE_FUNCTION = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+LADSPA_RUN = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_ulong)
+LADSPA_SET_RUN_ADDING_GAIN = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_float)
+
+LadspaDescriptor._fields_ = [("UniqueID", ctypes.c_ulong),
+                             ("Label", ctypes.c_char_p),
+                             ("Properties", ctypes.c_int),
+                             ("Name", ctypes.c_char_p),
+                             ("Maker", ctypes.c_char_p),
+                             ("Copyright", ctypes.c_char_p),
+                             ("PortCount", ctypes.c_ulong),
+                             ("PortDescriptors", ctypes.c_void_p),
+                             ("PortNames", ctypes.c_void_p),
+                             ("PortRangeHints", ctypes.c_void_p),
+                             ("ImplementationData", ctypes.c_void_p),
+                             ("instantiate", LADSPA_INSTANTIATE),
+                             ("connect_port", LADSPA_CONNECT_PORT),
+                             ("activate", LADSPA_HANDLE_FUNCTION),
+                             ("run", LADSPA_RUN),
+                             ("run_adding", LADSPA_RUN),
+                             ("set_run_adding_gain", LADSPA_SET_RUN_ADDING_GAIN),
+                             ("deactivate", LADSPA_HANDLE_FUNCTION),
+                             ("cleanup", LADSPA_HANDLE_FUNCTION),
+                             ]
 
 class LadspaPortRangeHint(ctypes.Structure):
     _fields_ = [("Descriptor", ctypes.c_int),
@@ -49,12 +68,31 @@ class LadspaPortRangeHint(ctypes.Structure):
                 ]
 
 
+def text(value):
+    """
+    Strings of descriptors have no declared encoding: they're decoded as utf-8 if
+    they're valid, or as latin-1 otherwise, which decodes any byte
+    """
+    if value is None:
+        return None
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+def load_library(path):
+    lib = ctypes.cdll.LoadLibrary(path)
+    lib.ladspa_descriptor.argtypes = [ ctypes.c_ulong ]
+    lib.ladspa_descriptor.restype = ctypes.POINTER(LadspaDescriptor)
+    return lib
+
 class Plugin(object):
 
-    def __init__(self, path):
+    def __init__(self, path, index=0, lib=None):
         self.path = path
-        self.lib = ctypes.cdll.LoadLibrary(path)
-        self.lib.ladspa_descriptor.restype = ctypes.POINTER(LadspaDescriptor)
+        self.index = index
+        self.lib = lib or load_library(path)
+        self._descriptor = None
 
         for key, value in self.descriptor.items():
             try:
@@ -68,11 +106,21 @@ class Plugin(object):
 
     @property
     def descriptor(self):
-        d = self.lib.ladspa_descriptor(None).contents
+        # ctypes extraction is done only once, descriptors are constant
+        if self._descriptor is None:
+            self._descriptor = self.extract_descriptor()
+        return self._descriptor
 
-        port_names = ctypes.cast(d.PortNames, ctypes.POINTER(ctypes.c_char_p * d.PortCount))
-        port_descs = ctypes.cast(d.PortDescriptors, ctypes.POINTER(ctypes.c_int * d.PortCount))
-        port_hints = ctypes.cast(d.PortRangeHints, ctypes.POINTER(LadspaPortRangeHint * d.PortCount))
+    def extract_descriptor(self):
+        d = self.lib.ladspa_descriptor(self.index)
+        if not d:
+            raise Exception("No plugin at index %d of %s" % (self.index, self.path))
+        d = d.contents
+
+        # Port arrays are copied at once, instead of one ctypes access per port
+        port_names = ctypes.cast(d.PortNames, ctypes.POINTER(ctypes.c_char_p * d.PortCount)).contents[:]
+        port_descs = ctypes.cast(d.PortDescriptors, ctypes.POINTER(ctypes.c_int * d.PortCount)).contents[:]
+        port_hints = ctypes.cast(d.PortRangeHints, ctypes.POINTER(LadspaPortRangeHint * d.PortCount)).contents[:]
 
         ports = {
             'audio': {
@@ -94,10 +142,10 @@ class Plugin(object):
                        }
 
         for i in range(d.PortCount):
-            port = {'name': port_names.contents[i] }
+            port = {'name': text(port_names[i]), 'index': i }
 
-            desc = port_descs.contents[i]
-            hint = port_hints.contents[i]
+            desc = port_descs[i]
+            hint = port_hints[i]
 
             if desc & LADSPA_PORT_INPUT:
                 direction = 'input'
@@ -172,11 +220,354 @@ class Plugin(object):
 
             ports[port_type][direction].append(port)
 
-        return {'label': d.Label,
+        return {'unique_id': d.UniqueID,
+                'index': self.index,
+                'label': text(d.Label),
                 'properties': d.Properties,
-                'name': d.Name,
-                'author': d.Maker,
-                'copyright': d.Copyright,
+                'name': text(d.Name),
+                'author': text(d.Maker),
+                'copyright': text(d.Copyright),
                 'ports': ports,
                 }
 
+
+
+class Instance(object):
+    """
+    A running instance of a ladspa plugin. Buffers connected to ports must be
+    float32 arrays (array.array('f') or numpy), which are passed to the plugin
+    without copying.
+    """
+
+    def __init__(self, plugin, sample_rate=48000):
+        self.handle = None
+        self.plugin = plugin
+        self.sample_rate = sample_rate
+        # pointer must be the one given by library, plugin may rely on its address
+        self.descriptor = plugin.lib.ladspa_descriptor(plugin.index)
+        self.functions = self.descriptor.contents
+        self.handle = self.functions.instantiate(self.descriptor, sample_rate)
+        if not self.handle:
+            raise Exception("Could not instantiate %s" % plugin.label)
+        # Buffers must be referenced while connected
+        self.buffers = {}
+        self.active = False
+
+    def connect(self, port, buffer):
+        self.buffers[port] = buffer
+        self.functions.connect_port(self.handle, port, float_pointer(buffer))
+
+    def activate(self):
+        if self.functions.activate:
+            self.functions.activate(self.handle)
+        self.active = True
+
+    def run(self, sample_count):
+        self.functions.run(self.handle, sample_count)
+
+    def deactivate(self):
+        if self.functions.deactivate and self.active:
+            self.functions.deactivate(self.handle)
+        self.active = False
+
+    def cleanup(self):
+        if self.handle is None:
+            return
+        self.deactivate()
+        self.functions.cleanup(self.handle)
+        self.handle = None
+        self.buffers = {}
+
+    def __del__(self):
+        self.cleanup()
+
+
+class Library(object):
+    """
+    A LADSPA shared object, which may contain any number of plugins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lib = load_library(path)
+
+    def plugins(self):
+        index = 0
+        # ladspa_descriptor returns NULL after last plugin
+        while self.lib.ladspa_descriptor(index):
+            yield Plugin(self.path, index, lib=self.lib)
+            index += 1
+
+    @property
+    def descriptors(self):
+        return [ plugin.descriptor for plugin in self.plugins() ]
+
+
+class Scanner(object):
+    """
+    Scans directories for LADSPA libraries, extracting descriptors of all plugins
+    in each library.
+
+    Results are cached by library path, size and modification time, so a library is
+    only loaded again if it changes. If cache_file is given, cache is kept there
+    as json between runs.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.cache = {}
+        self.errors = {}
+        if cache_file and os.path.exists(cache_file):
+            try:
+                self.cache = json.load(open(cache_file))
+            except ValueError:
+                pass
+
+    def _stat(self, path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+
+    def cached(self, path):
+        """
+        Returns cached descriptors of library, or None if library is not cached or has changed
+        """
+        size, mtime = self._stat(path)
+        cached = self.cache.get(path)
+        if cached and cached['size'] == size and cached['mtime'] == mtime:
+            return cached['plugins']
+
+    def store(self, path, plugins):
+        size, mtime = self._stat(path)
+        self.cache[path] = { 'size': size,
+                             'mtime': mtime,
+                             'plugins': plugins,
+                             }
+
+    def library(self, path):
+        """
+        Returns list of descriptors of all plugins in library
+        """
+        path = os.path.realpath(path)
+        plugins = self.cached(path)
+        if plugins is None:
+            plugins = Library(path).descriptors
+            self.store(path, plugins)
+        return plugins
+
+    def libraries(self, directory):
+        for topdir, dirnames, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith('.so'):
+                    yield os.path.realpath(os.path.join(topdir, filename))
+
+    def scan(self, directory='/usr/lib/ladspa', isolated=False, processes=None, timeout=10):
+        """
+        Returns a dictionary of library path => list of plugin descriptors for all
+        libraries found in directory. Libraries that fail to load are
+        left out and reported in self.errors. Libraries of directory that
+        don't exist anymore are removed from cache.
+
+        If isolated is True, libraries are loaded by scan_isolated() in worker
+        processes, instead of this one.
+        """
+        result = {}
+        missing = []
+        paths = list(self.libraries(directory))
+        for path in paths:
+            plugins = self.cached(path)
+            if plugins is None:
+                missing.append(path)
+            else:
+                result[path] = plugins
+                self.errors.pop(path, None)
+
+        prefix = os.path.join(os.path.realpath(directory), '')
+        for path in set(self.cache.keys() + self.errors.keys()) - set(paths):
+            if path.startswith(prefix):
+                self.cache.pop(path, None)
+                self.errors.pop(path, None)
+
+        if isolated:
+            extracted = scan_isolated(missing, processes, timeout)
+        else:
+            extracted = dict([ (path, extract(path)) for path in missing ])
+
+        for path, status in extracted.items():
+            if not status['ok']:
+                self.errors[path] = status['error']
+                continue
+            self.errors.pop(path, None)
+            self.store(path, status['plugins'])
+            result[path] = status['plugins']
+
+        if self.cache_file:
+            self.save()
+
+        return result
+
+    def save(self):
+        fh = open(self.cache_file, 'w')
+        json.dump(self.cache, fh)
+        fh.close()
+
+
+def extract(path):
+    """
+    Extracts descriptors of all plugins in library, in this process. Returns
+    same status as scan_isolated()
+    """
+    try:
+        return { 'ok': True, 'plugins': Library(path).descriptors }
+    except Exception as e:
+        return { 'ok': False, 'error': unicode(e) }
+
+class Worker(object):
+    """
+    A worker process of scan_isolated(), which reads library paths from stdin, one per
+    line, and answers each one with a line of json status in stdout.
+    """
+
+    def __init__(self, command, env):
+        # stderr goes to a file, so that a big output can't block the worker
+        self.err = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=self.err, env=env)
+        self.path = None
+        self.start = None
+        self.output = ''
+
+    def send(self, path):
+        self.path = path
+        self.start = time.time()
+        self.proc.stdin.write(path + '\n')
+        self.proc.stdin.flush()
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def read(self):
+        """
+        Reads available output. Returns status of current library once its line is
+        complete, or None. Raises EOFError if worker is dead.
+        """
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            raise EOFError()
+        self.output += data
+        if '\n' not in self.output:
+            return None
+        line, self.output = self.output.split('\n', 1)
+        self.path = None
+        return json.loads(line)
+
+    def error(self):
+        """
+        Reason of death of worker
+        """
+        self.proc.wait()
+        if self.proc.returncode < 0:
+            return u'Crashed with signal %d' % -self.proc.returncode
+        self.err.seek(0)
+        lines = self.err.read().strip().split('\n')
+        return lines[-1].decode('utf-8', 'replace') or u'Worker failed'
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.err.close()
+
+def scan_isolated(paths, processes=None, timeout=10, command=None):
+    """
+    Extracts descriptors of all plugins in several libraries in worker processes, so
+    that a library that crashes or hangs can't affect this process. At most
+    `processes` workers run at the same time (one per cpu by default), each one
+    extracting several libraries in turn. A worker that does not finish a library
+    in `timeout` seconds is killed, and workers that die are replaced by new ones.
+    `command` is the command line of workers, by default this module's __main__.
+
+    Returns a dictionary of library path => status, where status is either
+    { 'ok': True, 'plugins': [ descriptor, ... ] } or { 'ok': False, 'error': message }
+    """
+    processes = processes or multiprocessing.cpu_count()
+    command = command or [sys.executable, '-m', 'modcommon.ladspa']
+
+    # Worker must be able to import modcommon even if it's not installed
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + filter(None, [env.get('PYTHONPATH')]))
+
+    pending = list(paths)
+    workers = []
+    result = {}
+
+    def fail(worker, error):
+        result[worker.path] = { 'ok': False, 'error': error }
+        worker.close()
+        workers.remove(worker)
+
+    def send(worker):
+        try:
+            worker.send(pending.pop(0))
+        except IOError:
+            fail(worker, worker.error())
+
+    try:
+        while True:
+            for worker in list(workers):
+                if pending and worker.path is None:
+                    send(worker)
+            while pending and len(workers) < processes:
+                worker = Worker(command, env)
+                workers.append(worker)
+                send(worker)
+
+            busy = [ worker for worker in workers if worker.path is not None ]
+            if not busy:
+                break
+
+            now = time.time()
+            wait = min(worker.start + timeout for worker in busy) - now
+            ready = select.select(busy, [], [], max(0, min(wait, 1)))[0]
+            for worker in ready:
+                path = worker.path
+                try:
+                    status = worker.read()
+                except EOFError:
+                    fail(worker, worker.error())
+                    continue
+                except ValueError:
+                    fail(worker, u'Invalid output of worker')
+                    continue
+                if status is not None:
+                    result[path] = status
+
+            now = time.time()
+            for worker in busy:
+                if worker in workers and worker.path is not None and now - worker.start >= timeout:
+                    fail(worker, u'Timeout after %d seconds' % timeout)
+    finally:
+        for worker in workers:
+            worker.close()
+
+    return result
+
+def worker():
+    """
+    Main loop of a Worker process
+    """
+    # Plugins may print to stdout, so status goes to a copy of it and
+    # stdout itself is redirected to stderr
+    out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    for line in iter(sys.stdin.readline, ''):
+        out.write(json.dumps(extract(line.rstrip('\n'))) + '\n')
+        out.flush()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print json.dumps(extract(sys.argv[1]))
+    else:
+        worker()
@@ -1,5 +1,6 @@
-import rdflib, os, hashlib, re, random, shutil, subprocess
+import rdflib, os, hashlib, re, random, shutil, subprocess, ctypes
 from . import rdfmodel as model
+from .dsp import float_pointer
 
 # important so developers can catch lv2.BadSyntax instead of this huge path
 from rdflib.plugins.parsers.notation3 import BadSyntax
@@ -228,15 +229,15 @@ class Plugin(model.Model):
         d['ports']['control']['input'] =  d.pop('control_input_ports')
         d['ports']['control']['output'] = d.pop('control_output_ports')
 
-        # Get midi ports
+        # Get midi ports, either atom ports or old event ports
         d['ports']['midi'] = {'input':  [], 'output': [] }
 
-        for port in d.pop('atom_input_ports') + d.pop('event_input_ports'):
-            if port['midi']:
-                d['ports']['midi']['input'].append(port)
-        for port in d.pop('atom_output_ports') + d.pop('event_output_ports'):
-            if port['midi']:
-                d['ports']['midi']['output'].append(port)
+        for direction in ('input', 'output'):
+            for typ in ('atom', 'event'):
+                for port in d.pop('%s_%s_ports' % (typ, direction)):
+                    if port['midi']:
+                        port['type'] = typ
+                        d['ports']['midi'][direction].append(port)
 
 
         d['ports']['midi']['input'].sort(key=lambda port: port['index'])
@@ -395,3 +396,168 @@ class BundlePackage(object):
         return self.fh.tell()
     def seek(self, *args):
         return self.fh.seek(*args)
+
+
+class Lv2Feature(ctypes.Structure):
+    _fields_ = [("URI", ctypes.c_char_p),
+                ("data", ctypes.c_void_p),
+                ]
+
+class Lv2Descriptor(ctypes.Structure):
+    pass
+
+LV2_INSTANTIATE = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.POINTER(Lv2Descriptor), ctypes.c_double,
+                                   ctypes.c_char_p, ctypes.POINTER(ctypes.POINTER(Lv2Feature)))
+LV2_CONNECT_PORT = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p)
+LV2_HANDLE_FUNCTION = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+LV2_RUN = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32)
+LV2_EXTENSION_DATA = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p)
+
+Lv2Descriptor._fields_ = [("URI", ctypes.c_char_p),
+                          ("instantiate", LV2_INSTANTIATE),
+                          ("connect_port", LV2_CONNECT_PORT),
+                          ("activate", LV2_HANDLE_FUNCTION),
+                          ("run", LV2_RUN),
+                          ("deactivate", LV2_HANDLE_FUNCTION),
+                          ("cleanup", LV2_HANDLE_FUNCTION),
+                          ("extension_data", LV2_EXTENSION_DATA),
+                          ]
+
+LV2_URID_MAP_FUNCTION = ctypes.CFUNCTYPE(ctypes.c_uint32, ctypes.c_void_p, ctypes.c_char_p)
+
+class Lv2UridMap(ctypes.Structure):
+    _fields_ = [("handle", ctypes.c_void_p),
+                ("map", LV2_URID_MAP_FUNCTION),
+                ]
+
+class UridMap(object):
+    """
+    Stand-in for host urid:map feature, mapping uris to sequential integers.
+    A uri is always mapped to the same urid, and unmap() gives the uri back.
+    """
+
+    def __init__(self):
+        self.urids = {}
+        self.uris = {}
+        # callback and structures must be referenced while plugin lives
+        self._callback = LV2_URID_MAP_FUNCTION(lambda handle, uri: self.map(uri))
+        self._map = Lv2UridMap(None, self._callback)
+        self.feature = Lv2Feature('http://lv2plug.in/ns/ext/urid#map',
+                                  ctypes.cast(ctypes.pointer(self._map), ctypes.c_void_p))
+
+    def map(self, uri):
+        try:
+            return self.urids[uri]
+        except KeyError:
+            urid = self.urids[uri] = len(self.urids) + 1
+            self.uris[urid] = uri
+            return urid
+
+    def unmap(self, urid):
+        return self.uris.get(urid)
+
+class Lv2AtomSequence(ctypes.Structure):
+    # LV2_Atom header followed by LV2_Atom_Sequence_Body, with no events
+    _fields_ = [("size", ctypes.c_uint32),
+                ("type", ctypes.c_uint32),
+                ("unit", ctypes.c_uint32),
+                ("pad", ctypes.c_uint32),
+                ]
+
+class Instance(object):
+    """
+    A running instance of an lv2 plugin, given its data as extracted by Bundle.
+
+    The only feature provided to the plugin is urid:map. Midi atom ports are connected
+    to empty atom sequences. Event ports (lv2ev:EventPort, whose buffers have another
+    layout) and ports not present in plugin data (like non-midi atom ports) are left
+    unconnected. Audio and control buffers must be float32 arrays
+    (array.array('f') or numpy), which are passed to the plugin without copying.
+    """
+
+    atom_capacity = 8192
+
+    def __init__(self, plugin, sample_rate=48000):
+        self.handle = None
+        self.plugin = plugin
+        self.sample_rate = sample_rate
+        self.lib = ctypes.cdll.LoadLibrary(plugin['binary'])
+        self.lib.lv2_descriptor.argtypes = [ ctypes.c_uint32 ]
+        self.lib.lv2_descriptor.restype = ctypes.POINTER(Lv2Descriptor)
+
+        self.descriptor = None
+        index = 0
+        while True:
+            descriptor = self.lib.lv2_descriptor(index)
+            if not descriptor:
+                raise Exception("%s not found in %s" % (plugin['url'], plugin['binary']))
+            if descriptor.contents.URI == plugin['url']:
+                break
+            index += 1
+        self.descriptor = descriptor
+        self.functions = descriptor.contents
+
+        self.urid_map = UridMap()
+        self._features = (ctypes.POINTER(Lv2Feature) * 2)(ctypes.pointer(self.urid_map.feature), None)
+
+        bundle_path = os.path.dirname(plugin['binary']) + '/'
+        self.handle = self.functions.instantiate(self.descriptor, sample_rate, bundle_path, self._features)
+        if not self.handle:
+            raise Exception("Could not instantiate %s" % plugin['url'])
+
+        self.buffers = {}
+        self.active = False
+
+        self.atom_outputs = []
+        self.connect_midi()
+
+    def connect_midi(self):
+        """
+        Connects midi atom ports to empty sequences, output ones must have capacity reset
+        before each run
+        """
+        for port in self.plugin['ports']['midi']['input']:
+            if port.get('type') == 'atom':
+                self.connect_atom(port['index'], self.urid_map.map(str(atom.Sequence)))
+        for port in self.plugin['ports']['midi']['output']:
+            if port.get('type') == 'atom':
+                self.atom_outputs.append(self.connect_atom(port['index'], self.urid_map.map(str(atom.Chunk))))
+
+    def connect_atom(self, port, urid):
+        buf = ctypes.create_string_buffer(self.atom_capacity)
+        seq = Lv2AtomSequence.from_buffer(buf)
+        seq.type = urid
+        seq.size = ctypes.sizeof(Lv2AtomSequence) - 8
+        self.buffers[port] = buf
+        self.functions.connect_port(self.handle, port, ctypes.addressof(buf))
+        return seq
+
+    def connect(self, port, buffer):
+        self.buffers[port] = buffer
+        self.functions.connect_port(self.handle, port, ctypes.cast(float_pointer(buffer), ctypes.c_void_p))
+
+    def activate(self):
+        if self.functions.activate:
+            self.functions.activate(self.handle)
+        self.active = True
+
+    def run(self, sample_count):
+        for seq in self.atom_outputs:
+            seq.size = self.atom_capacity - 8
+        self.functions.run(self.handle, sample_count)
+
+    def deactivate(self):
+        if self.functions.deactivate and self.active:
+            self.functions.deactivate(self.handle)
+        self.active = False
+
+    def cleanup(self):
+        if self.handle is None:
+            return
+        self.deactivate()
+        self.functions.cleanup(self.handle)
+        self.handle = None
+        self.buffers = {}
+
+    def __del__(self):
+        self.cleanup()
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory search backend, for small catalogs on slow storage, like the device's flash.
+
+MemoryIndex has the same API as indexing.Index: documents are indexed by the same schemas
+and analyzed like whoosh would (NGRAMWORDS, TEXT, ID, KEYWORD and NUMERIC fields), but
+kept in memory as inverted postings, one array of document numbers per term. No whoosh
+storage is used: the whole index is written to a single snapshot file at index_path
+by add_many, delete_many and flush(), and read back when opened. add and delete only
+change the index in memory, so that single changes don't rewrite the whole file. Shared
+indexes (see indexing.get_index) are flushed on process exit.
+
+To use it, set the searcher's index_class to MemoryEffectIndex or MemoryPedalboardIndex:
+
+    class EffectSearcher(indexing.EffectSearcher):
+        index_class = memindex.MemoryEffectIndex
+        index_path = '/data/effects.idx'
+
+Search terms are split by whitespace, and each word must be found in some of term_fields,
+so whoosh query syntax (quotes, field:value, AND/OR/NOT) is not understood.
+"""
+
+import os, re, json, math, array, threading
+
+from modcommon import json_handler
+from modcommon.indexing import Index, EffectIndex, PedalboardIndex, RANGES, number, parse_predicate, measured
+
+WORDS = re.compile(r'\w+(\.?\w+)*', re.UNICODE)
+
+# same as whoosh's StandardAnalyzer
+STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'for', 'from', 'have',
+                        'if', 'in', 'is', 'it', 'may', 'not', 'of', 'on', 'or', 'tbd', 'that', 'the',
+                        'this', 'to', 'us', 'we', 'when', 'will', 'with', 'yet', 'you', 'your'])
+
+# Queries are tuples, so that they can be used as cache keys
+ALL = ('all',)
+
+def words(text):
+    return [ match.group(0) for match in WORDS.finditer(unicode(text).lower()) ]
+
+class Field(object):
+    """
+    Analysis of a whoosh field: tokens to be indexed for a value, and
+    tokens that a search word must match
+    """
+
+    def __init__(self, field):
+        self.kind = field.__class__.__name__
+        self.stored = field.stored
+        self.indexed = self.kind != 'STORED'
+        if self.kind == 'NGRAMWORDS':
+            ngrams = field.analyzer.items[-1]
+            self.minsize, self.maxsize = ngrams.min, ngrams.max
+        if self.kind == 'KEYWORD':
+            filters = [ item.__class__.__name__ for item in getattr(field.analyzer, 'items', []) ]
+            self.commas = 'StripFilter' in filters
+            self.lowercase = 'LowercaseFilter' in filters
+
+    def tokens(self, value, query=False):
+        if value is None or value == u'':
+            return []
+        if self.kind == 'NUMERIC':
+            if isinstance(value, (list, tuple)):
+                return [ number(v) for v in value ]
+            return [ number(value) ]
+        if self.kind == 'ID':
+            return [ unicode(value) ]
+        if self.kind == 'KEYWORD':
+            if isinstance(value, (list, tuple)):
+                value = (u',' if self.commas else u' ').join(value)
+            value = unicode(value)
+            if self.lowercase:
+                value = value.lower()
+            if self.commas:
+                return [ token.strip() for token in value.split(u',') if token.strip() ]
+            return value.split()
+        if self.kind == 'TEXT':
+            return [ word for word in words(value) if len(word) >= 2 and word not in STOP_WORDS ]
+        if self.kind == 'NGRAMWORDS':
+            tokens = []
+            for word in words(value):
+                if len(word) < self.minsize:
+                    continue
+                if query:
+                    # a word is searched by all its grams of the largest size
+                    size = min(self.maxsize, len(word))
+                    sizes = [ size ]
+                else:
+                    sizes = range(self.minsize, min(self.maxsize, len(word)) + 1)
+                for size in sizes:
+                    for start in range(len(word) - size + 1):
+                        tokens.append(word[start:start+size])
+            return tokens
+        return []
+
+class MemoryIndex(Index):
+
+    # deleted documents are kept in postings until they're this fraction of all documents
+    compact_ratio = 0.5
+
+    def open(self, index_path):
+        self.path = index_path
+        self.fields = dict([ (name, Field(field)) for name, field in self.schema.items() ])
+        self.stored_names = [ name for name, field in self.fields.items() if field.stored ]
+        self._lock = threading.RLock()
+        self._generation = 0
+        # whether there are commits not written to snapshot yet
+        self._dirty = False
+        self.load()
+
+    def adopt(self, snapshot, index_path):
+        raise Exception("Memory indexes are loaded from their own snapshot file")
+
+    @property
+    def index_schema(self):
+        return self.schema
+
+    def load(self):
+        self.docs = []
+        self.ids = {}
+        self.deleted = 0
+        # field => { token => array of document numbers }
+        self.postings = dict([ (name, {}) for name, field in self.fields.items() if field.indexed ])
+        if not os.path.exists(self.path):
+            return
+        snapshot = json.load(open(self.path))
+        self._generation = snapshot['generation']
+        for data in snapshot['documents']:
+            self.insert(data)
+
+    def save(self):
+        """
+        Writes all documents to a single file, replacing previous snapshot at once
+        """
+        tmp = self.path + '.tmp'
+        fh = open(tmp, 'w')
+        json.dump({ 'generation': self._generation,
+                    'documents': [ data for data in self.docs if data is not None ],
+                    }, fh, default=json_handler)
+        fh.close()
+        os.rename(tmp, self.path)
+        self._dirty = False
+
+    def flush(self):
+        """
+        Writes snapshot if there are changes made by add or delete
+        """
+        super(MemoryIndex, self).flush()
+        with self._lock:
+            if self._dirty:
+                self.save()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def insert(self, data):
+        objid = data['id']
+        if objid in self.ids:
+            self.remove(objid)
+        docnum = len(self.docs)
+        self.docs.append(data)
+        self.ids[objid] = docnum
+        for name, postings in self.postings.items():
+            for token in set(self.fields[name].tokens(data.get(name))):
+                try:
+                    postings[token].append(docnum)
+                except KeyError:
+                    postings[token] = array.array('i', [docnum])
+
+    def remove(self, objid):
+        try:
+            docnum = self.ids.pop(objid)
+        except KeyError:
+            return False
+        # postings are cleaned by compact()
+        self.docs[docnum] = None
+        self.deleted += 1
+        return True
+
+    def compact(self):
+        if self.deleted > len(self.docs) * self.compact_ratio:
+            self.rebuild()
+
+    def rebuild(self, docs=None):
+        if docs is None:
+            docs = [ data for data in self.docs if data is not None ]
+        self.docs = []
+        self.ids = {}
+        self.deleted = 0
+        self.postings = dict([ (name, {}) for name in self.postings ])
+        for data in docs:
+            self.insert(data)
+
+    def replace(self, objects):
+        documents = [ self.prepare(obj) for obj in objects ]
+        with self._lock:
+            self.rebuild(documents)
+            self._generation += 1
+            with self.metrics.timer('commit'):
+                self.save()
+        return documents
+
+    def commit(self, documents=(), deleted=(), save=True):
+        self._generation += 1
+        with self.metrics.timer('commit'):
+            self.compact()
+            if save:
+                self.save()
+            else:
+                self._dirty = True
+        self.committed(documents, deleted)
+
+    @measured('add')
+    def add(self, obj):
+        data = self.prepare(obj)
+        with self._lock:
+            self.insert(data)
+            self.commit([data], save=False)
+
+    @measured('add_many')
+    def add_many(self, objs, update=True, **kwargs):
+        """
+        Indexes all objects from an iterable, with a single snapshot write.
+        Writer options of Index.add_many are accepted and ignored.
+        """
+        documents = [ self.prepare(obj) for obj in objs ]
+        with self._lock:
+            for data in documents:
+                self.insert(data)
+            self.commit(documents)
+        return len(documents)
+
+    @measured('delete')
+    def delete(self, objid):
+        with self._lock:
+            found = self.remove(objid)
+            self.commit(deleted=[objid], save=False)
+        return found
+
+    @measured('delete_many')
+    def delete_many(self, objids):
+        objids = [ unicode(objid) for objid in objids ]
+        if not objids:
+            return 0
+        with self._lock:
+            count = len([ objid for objid in objids if self.remove(objid) ])
+            self.commit(deleted=objids)
+        return count
+
+    def stats(self):
+        return { 'documents': len(self.ids),
+                 'segments': 1,
+                 'deleted': self.deleted,
+                 'outdated': self.outdated(),
+                 'size': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+                 'generation': self.generation,
+                 }
+
+    def optimize(self):
+        """
+        Discards deleted documents from postings
+        """
+        with self._lock:
+            if self.deleted:
+                self.rebuild()
+
+    def fields_of(self, data, raw=False):
+        fields = {}
+        for name in self.stored_names:
+            if name in data and (raw or name != 'json'):
+                fields[name] = data[name]
+        return fields
+
+    def documents(self):
+        return [ self.fields_of(data) for data in self.docs if data is not None ]
+
+    def stored(self, objid):
+        try:
+            return self.fields_of(self.docs[self.ids[unicode(objid)]])
+        except KeyError:
+            return None
+
+    # Queries
+
+    def every_query(self):
+        return ALL
+
+    def term(self, name, value):
+        if name not in self.fields:
+            # matches nothing, as in whoosh
+            return ('term', name, unicode(value))
+        tokens = self.fields[name].tokens(value)
+        if len(tokens) != 1:
+            return ('and', tuple([ ('term', name, token) for token in tokens ]))
+        return ('term', name, tokens[0])
+
+    def find_query(self, **kwargs):
+        return ('and', tuple([ self.term(key, value) for key, value in sorted(kwargs.items()) ]))
+
+    def term_query(self, query):
+        terms = []
+        if query.get('term'):
+            for word in unicode(query['term'][0]).split():
+                alternatives = []
+                for name in self.term_fields:
+                    tokens = self.fields[name].tokens(word, query=True)
+                    if tokens:
+                        alternatives.append(('and', tuple([ ('term', name, token) for token in tokens ])))
+                if alternatives:
+                    terms.append(('or', tuple(alternatives)))
+        for key, values in sorted(query.items()):
+            if key == 'term':
+                continue
+            if key == 'where':
+                for expression in sorted(values):
+                    terms.append(self.predicate_query(*parse_predicate(expression, self.schema)))
+                continue
+            terms.append(('or', tuple([ self.term(key, unicode(value)) for value in sorted(values) ])))
+        return ('and', tuple(terms))
+
+    def predicate_query(self, field, operator, values):
+        if operator in RANGES:
+            return ('range', field) + RANGES[operator](values[0])
+        return ('or', tuple([ ('term', field, value) for value in sorted(values) ]))
+
+    def match(self, query):
+        """
+        Returns a dictionary of document number => score of documents matching query
+        """
+        kind = query[0]
+        if kind == 'term':
+            try:
+                postings = self.postings[query[1]][query[2]]
+            except KeyError:
+                return {}
+            return dict([ (docnum, 1) for docnum in postings if self.docs[docnum] is not None ])
+        if kind == 'range':
+            # numeric fields have few distinct values, so all of them are checked
+            name, start, end, startexcl, endexcl = query[1:]
+            result = {}
+            for value, postings in self.postings[name].items():
+                if start is not None and (value < start or startexcl and value == start):
+                    continue
+                if end is not None and (value > end or endexcl and value == end):
+                    continue
+                for docnum in postings:
+                    if self.docs[docnum] is not None:
+                        result[docnum] = 1
+            return result
+        if kind == 'all':
+            return dict([ (docnum, 0) for docnum in self.ids.values() ])
+        if not query[1]:
+            return {}
+
+        matches = [ self.match(subquery) for subquery in query[1] ]
+        if kind == 'or':
+            result = {}
+            for match in matches:
+                for docnum, score in match.items():
+                    result[docnum] = result.get(docnum, 0) + score
+            return result
+
+        matches.sort(key=len)
+        result = matches[0]
+        for match in matches[1:]:
+            result = dict([ (docnum, score + match[docnum])
+                            for docnum, score in result.items() if docnum in match ])
+        return result
+
+    def ranked(self, query, sortedby=None, reverse=False):
+        """
+        Stored fields of documents matching query, by descending score or by sortedby field
+        """
+        with self._lock:
+            matches = self.match(query)
+            if sortedby is None:
+                docnums = sorted(matches, key=lambda docnum: (-matches[docnum], docnum))
+            else:
+                docnums = sorted(matches, key=lambda docnum: (self.docs[docnum].get(sortedby), docnum))
+            if reverse:
+                docnums.reverse()
+            return [ self.fields_of(self.docs[docnum], raw=True) for docnum in docnums ]
+
+    def hits(self, query, page=None, pagelen=20, limit=None, sortedby=None, reverse=False, raw=False):
+        if page is not None:
+            return self.paginate(query, page, pagelen, sortedby, reverse, raw)['results']
+        key = (query, limit, sortedby, reverse, self.generation)
+        def compute():
+            return self.ranked(query, sortedby, reverse)[:limit]
+        return self.copies(self.cache.get(key, compute), raw)
+
+    def paginate(self, query, page=1, pagelen=20, sortedby=None, reverse=False, raw=False):
+        key = ('page', query, page, pagelen, sortedby, reverse, self.generation)
+        def compute():
+            results = self.ranked(query, sortedby, reverse)
+            pagecount = int(math.ceil(len(results) / float(pagelen)))
+            pagenum = min(pagecount, page)
+            offset = max(pagenum - 1, 0) * pagelen
+            return { 'total': len(results),
+                     'page': pagenum,
+                     'pagecount': pagecount,
+                     'pagelen': pagelen,
+                     'results': results[offset:offset+pagelen],
+                     }
+        result = dict(self.cache.get(key, compute))
+        result['results'] = self.copies(result['results'], raw)
+        return result
+
+    def facets(self, query, fields):
+        fields = sorted(fields)
+        key = ('facets', query, tuple(fields), self.generation)
+        def compute():
+            with self._lock:
+                docs = [ self.docs[docnum] for docnum in self.match(query) ]
+            counts = {}
+            for field in fields:
+                groups = {}
+                for data in docs:
+                    value = data.get(field)
+                    if value not in (u'', None):
+                        groups[value] = groups.get(value, 0) + 1
+                counts[field] = sorted([ [value, count] for value, count in groups.items() ],
+                                       key=lambda group: (-group[1], group[0]))
+            return { 'total': len(docs), 'facets': counts }
+        result = self.cache.get(key, compute)
+        return { 'total': result['total'],
+                 'facets': dict([ (field, [ list(group) for group in groups ])
+                                  for field, groups in result['facets'].items() ]),
+                 }
+
+class MemoryEffectIndex(EffectIndex, MemoryIndex):
+    pass
+
+class MemoryPedalboardIndex(PedalboardIndex, MemoryIndex):
+    pass
@@ -1,13 +1,40 @@
-def hardware_connections(pedalboard):
-    m = {
-        'audio_inputs': 0,
-        'audio_outputs': 0,
-        'midi_inputs': 0,
-        'midi_outputs': 0,
-        'rotary_addressings': 0,
-        'footswitch_addressings': 0,
-        'pedal_addressings': 0,
-        }
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Addressing type of each actuator, as (hwtype, acttype, type) rules. The first rule
+# matching the actuator's hwtype and acttype wins, acttype None matches any acttype.
+ACTUATORS = (
+    (0, 1, 'footswitch'), # hwtype quadra acttype footswitch
+    (0, 2, 'rotary'),     # hwtype quadra acttype rotary
+    (1, None, 'pedal'),   # hwtype expression pedal
+    )
+
+CONNECTIONS = ('audio_inputs', 'audio_outputs', 'midi_inputs', 'midi_outputs')
+
+def actuator_type(actuator, actuators=ACTUATORS):
+    """
+    Addressing type of an actuator [hwtype, hwid, acttype, actid], or None
+    """
+    for hwtype, acttype, typ in actuators:
+        if actuator[0] == hwtype and (acttype is None or actuator[2] == acttype):
+            return typ
+    return None
+
+def requirement_columns(actuators=ACTUATORS):
+    """
+    Names of the hardware requirements of pedalboards, in the column order of requirements()
+    """
+    columns = list(CONNECTIONS)
+    for hwtype, acttype, typ in actuators:
+        column = '%s_addressings' % typ
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+def hardware_connections(pedalboard, actuators=ACTUATORS):
+    m = dict((column, 0) for column in requirement_columns(actuators))
     for connection in pedalboard['connections']:
         if connection[0] == 'system':
             if connection[1].startswith('midi'):
@@ -22,19 +49,35 @@ def hardware_connections(pedalboard):
     for instance in pedalboard['instances']:
         addressing = instance.get('addressing', {})
         for symbol, address in addressing.items():
-            actuator = address.get('actuator', [-1, -1, -1, -1])
-            # TODO hardcoded hardware IDs here
-            if actuator[0] == 0 and actuator[2] == 1:
-                # hwtype quadra acttype footswitch
-                typ = 'footswitch'
-            elif actuator[0] == 0 and actuator[2] == 2:
-                # hwtype quadra acttype rotary
-                typ = 'rotary'
-            elif actuator[0] == 1:
-                # hwtype expression pedal
-                typ = 'pedal'
-            else:
-                continue
-            m['%s_addressings' % typ] += 1
+            typ = actuator_type(address.get('actuator', [-1, -1, -1, -1]), actuators)
+            if typ is not None:
+                m['%s_addressings' % typ] += 1
 
     return m
+
+def requirements(pedalboards, actuators=ACTUATORS):
+    """
+    Hardware requirements of many pedalboards, as a matrix with one row per pedalboard
+    and one column per requirement_columns(actuators). The matrix is a numpy int32 array
+    if numpy is available, or else a list of lists.
+    """
+    columns = requirement_columns(actuators)
+    rows = []
+    for pedalboard in pedalboards:
+        m = hardware_connections(pedalboard, actuators)
+        rows.append([ m[column] for column in columns ])
+    if numpy is None:
+        return rows
+    return numpy.array(rows, dtype=numpy.int32).reshape(len(rows), len(columns))
+
+def fits(matrix, hardware, actuators=ACTUATORS):
+    """
+    Which pedalboards of a requirements() matrix can be used in a hardware, given as a
+    dict of available inputs, outputs and actuators by column name (missing ones are 0).
+    Returns a boolean numpy array, or a list of bools if matrix is a list.
+    """
+    limits = [ hardware.get(column, 0) for column in requirement_columns(actuators) ]
+    if numpy is not None and isinstance(matrix, numpy.ndarray):
+        return (matrix <= numpy.array(limits, dtype=matrix.dtype)).all(axis=1)
+    return [ all(required <= limit for required, limit in zip(row, limits))
+             for row in matrix ]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Prebuilt index snapshots.
+
+Instead of each device indexing the catalog after install, the build server creates the
+index once, merged into a single segment, and ships it as a tgz file:
+
+    python -m modcommon.snapshot effect catalog.json effects-index.tgz
+
+where catalog.json is a list of effects, as they would be given to EffectIndex.add.
+The package contains the index directory and a snapshot.json manifest with the md5
+checksum of the index files. Devices open the index with:
+
+    EffectIndex(index_path, snapshot='effects-index.tgz')
+
+which verifies the package and swaps it in place of the existing index, unless that
+same snapshot is already installed.
+"""
+
+import os, sys, json, shutil, hashlib, tarfile, tempfile, argparse
+
+MANIFEST = 'snapshot.json'
+
+class InvalidSnapshot(Exception):
+    pass
+
+def checksum(path):
+    """
+    md5 of all files of an index directory, by name and content
+    """
+    result = hashlib.md5()
+    for name in sorted(os.listdir(path)):
+        filename = os.path.join(path, name)
+        if name == MANIFEST or not os.path.isfile(filename):
+            continue
+        result.update(name)
+        result.update(hashlib.md5(open(filename, 'rb').read()).hexdigest())
+    return result.hexdigest()
+
+def build(index_class, objects, index_path, procs=1):
+    """
+    Indexes all objects in a new, optimized index at index_path, and writes its manifest.
+    Returns the manifest.
+    """
+    if os.path.exists(index_path):
+        raise Exception("%s already exists" % index_path)
+    index = index_class(index_path)
+    count = index.add_many(objects, procs=procs, update=False, optimize=True)
+
+    manifest = { 'index': index_class.__name__,
+                 'documents': count,
+                 'checksum': checksum(index_path),
+                 }
+    json.dump(manifest, open(os.path.join(index_path, MANIFEST), 'w'))
+    return manifest
+
+def package(index_path, filename):
+    """
+    Packs index directory, built by build(), as a tgz file. Returns index checksum.
+    """
+    manifest = json.load(open(os.path.join(index_path, MANIFEST)))
+    tar = tarfile.open(filename, 'w:gz')
+    try:
+        tar.add(index_path, arcname='index')
+    finally:
+        tar.close()
+    return manifest['checksum']
+
+def installed(index_path):
+    """
+    Manifest of snapshot installed at index_path, or None
+    """
+    try:
+        return json.load(open(os.path.join(index_path, MANIFEST)))
+    except (IOError, ValueError):
+        return None
+
+def extract(filename, destination):
+    """
+    Extracts snapshot package to destination directory and verifies its checksum.
+    Returns its manifest.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(destination))
+    try:
+        tar = tarfile.open(filename, 'r:gz')
+        try:
+            for member in tar.getmembers():
+                if not (member.name == 'index' or member.name.startswith('index/')) or \
+                        '..' in member.name.split('/') or not (member.isfile() or member.isdir()):
+                    raise InvalidSnapshot("Unexpected file in snapshot: %s" % member.name)
+            tar.extractall(tmp_dir)
+        finally:
+            tar.close()
+
+        path = os.path.join(tmp_dir, 'index')
+        manifest = installed(path)
+        if manifest is None:
+            raise InvalidSnapshot("Snapshot has no manifest")
+        if checksum(path) != manifest['checksum']:
+            raise InvalidSnapshot("Snapshot checksum does not match")
+        os.rename(path, destination)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return manifest
+
+def install(filename, index_path):
+    """
+    Replaces the index at index_path by the snapshot in filename, if it's not already
+    installed. The new index is extracted and verified beside the current one, which
+    is only replaced when it's complete. Returns True if snapshot was installed.
+    """
+    index_path = os.path.realpath(index_path)
+    new_path = index_path + '.new'
+    old_path = index_path + '.old'
+
+    # leftovers of an interrupted install
+    if not os.path.exists(index_path) and os.path.exists(new_path):
+        os.rename(new_path, index_path)
+    for path in (new_path, old_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    manifest = extract(filename, new_path)
+    current = installed(index_path)
+    if current is not None and current['checksum'] == manifest['checksum']:
+        shutil.rmtree(new_path)
+        return False
+
+    if os.path.exists(index_path):
+        os.rename(index_path, old_path)
+    os.rename(new_path, index_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    return True
+
+def main(argv=None):
+    from modcommon.indexing import EffectIndex, PedalboardIndex
+    kinds = { 'effect': EffectIndex, 'pedalboard': PedalboardIndex }
+
+    parser = argparse.ArgumentParser(description="Builds an index snapshot from a catalog")
+    parser.add_argument('kind', choices=sorted(kinds.keys()))
+    parser.add_argument('catalog', help="json file with a list of objects")
+    parser.add_argument('output', help="tgz file to be created")
+    parser.add_argument('--procs', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        index_path = os.path.join(tmp_dir, 'index')
+        manifest = build(kinds[args.kind], json.load(open(args.catalog)), index_path, args.procs)
+        package(index_path, args.output)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print json.dumps(manifest, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8
+
+import unittest, os, shutil, tempfile
+from nose.plugins.attrib import attr
+from modcommon.lv2 import Bundle
+from modcommon.benchmark import generate_bundle, measure, STAGES
+
+class SyntheticBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @attr(slow=1)
+    def test_generated_bundle_is_extracted(self):
+        path = generate_bundle(os.path.join(self.tmp_dir, 'synthetic.lv2'),
+                               plugins=3, ports=4, scale_points=5, presets=2, see_also=3)
+        plugins = Bundle(path).data['plugins']
+
+        self.assertEquals(len(plugins), 3)
+
+        plugin = plugins['http://portalmod.com/plugins/synthetic/synthetic/1']
+        self.assertEquals(plugin['name'], 'Synthetic synthetic 1')
+        self.assertEquals(plugin['stability'], 'stable')
+        self.assertEquals(len(plugin['ports']['audio']['input']), 2)
+        self.assertEquals(len(plugin['ports']['audio']['output']), 2)
+        self.assertEquals(len(plugin['ports']['control']['input']), 4)
+
+        port = plugin['ports']['control']['input'][0]
+        self.assertEquals(port['symbol'], 'control0')
+        self.assertEquals(len(port['scalePoints']), 5)
+        self.assertEquals(port['scalePoints'][4], {'label': u'Point 4', 'value': 4.0})
+
+        self.assertEquals(sorted(plugin['presets'].keys()), ['Preset 0', 'Preset 1'])
+        self.assertEquals(len(plugin['presets']['Preset 1']['ports']), 4)
+
+    @attr(slow=1)
+    def test_all_stages_are_measured(self):
+        path = generate_bundle(os.path.join(self.tmp_dir, 'synthetic.lv2'), plugins=1, ports=1)
+        for stage in STAGES:
+            result = measure(path, stage, repeat=2)
+            self.assertEquals(result['stage'], stage)
+            self.assertEquals(result['bundle'], 'synthetic.lv2')
+            self.assertTrue(0 <= result['min'] <= result['median'] <= result['max'])
@@ -0,0 +1,74 @@
+# -*- coding: utf-8
+
+import unittest, os, shutil, tempfile
+from modcommon import discovery
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def manifest(self, content):
+        open(os.path.join(self.tmp_dir, 'manifest.ttl'), 'w').write(content)
+        return self.tmp_dir
+
+    def test_invada_plugins(self):
+        plugins = discovery.discover(os.path.join(ROOT, 'invada.lv2'))
+        self.assertEquals(len(plugins), 18)
+
+        plugin = plugins['http://invadarecords.com/plugins/lv2/compressor/stereo']
+        self.assertEquals(plugin['binary'], os.path.join(ROOT, 'invada.lv2', 'inv_compressor.so'))
+        self.assertEquals(plugin['seeAlso'], [os.path.join(ROOT, 'invada.lv2', 'inv_compressor.ttl')])
+
+    def test_result_is_the_same_as_rdflib(self):
+        for bundle in ('invada.lv2', 'calf.lv2'):
+            path = os.path.join(ROOT, bundle, 'manifest.ttl')
+            self.assertEquals(discovery.discover(path),
+                              discovery._collect(discovery._rdflib_triples(path)))
+
+    def test_class_declarations_are_not_plugins(self):
+        plugins = discovery.discover(os.path.join(ROOT, 'calf.lv2'))
+        self.assertEquals(len(plugins), 11)
+        self.assertTrue('http://foltman.com/ns/MIDIPlugin' not in plugins)
+
+    def test_object_lists_and_literals(self):
+        path = self.manifest('''@prefix lv2: <http://lv2plug.in/ns/lv2core#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+@base <http://example.com/> .
+
+# comment with <iri> and "string"
+<plugin> a lv2:Plugin, lv2:DelayPlugin ;
+    rdfs:comment """multiline
+    "text" ; with . punctuation""" , 'other'@en ;
+    lv2:minorVersion 2 ;
+    lv2:binary <file:///lib/plugin.so> ;
+    rdfs:seeAlso <file:///lib/plugin.ttl>, <file:///lib/more.ttl> ; .
+''')
+        plugins = discovery.discover(path)
+        self.assertEquals(plugins, { 'http://example.com/plugin': {
+                    'binary': '/lib/plugin.so',
+                    'seeAlso': ['/lib/more.ttl', '/lib/plugin.ttl'],
+                    }})
+
+    def test_fallback_to_rdflib(self):
+        path = self.manifest('''@prefix lv2: <http://lv2plug.in/ns/lv2core#> .
+<http://example.com/plugin> a lv2:Plugin ;
+    lv2:binary <plugin.so> ;
+    lv2:optionalFeature [ a lv2:Feature ] .
+''')
+        text = open(os.path.join(path, 'manifest.ttl')).read()
+        self.assertRaises(discovery.Unsupported,
+                          lambda: list(discovery.ManifestScanner(text, 'file://%s/' % path).triples()))
+        plugins = discovery.discover(path)
+        self.assertEquals(plugins['http://example.com/plugin']['binary'],
+                          os.path.join(os.path.realpath(path), 'plugin.so'))
+
+    def test_discover_all(self):
+        bundles = discovery.discover_all(ROOT)
+        self.assertEquals(sorted(bundles.keys()),
+                          [os.path.join(ROOT, 'calf.lv2'), os.path.join(ROOT, 'invada.lv2')])
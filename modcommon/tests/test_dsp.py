@@ -0,0 +1,140 @@
+# -*- coding: utf-8
+
+import unittest, ctypes, sys, json, os
+from cStringIO import StringIO
+from nose.plugins.attrib import attr
+from modcommon import dsp, lv2
+
+class FakeInstance(object):
+    """
+    Behaves like a gain plugin, with control port 0, input 1 and output 2
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.runs = []
+        self.active = False
+
+    def connect(self, port, buf):
+        self.buffers[port] = buf
+
+    def activate(self):
+        self.active = True
+
+    def deactivate(self):
+        self.active = False
+
+    def run(self, sample_count):
+        assert self.active
+        gain = self.buffers[0][0]
+        for i in range(sample_count):
+            self.buffers[2][i] = self.buffers[1][i] * gain
+        self.runs.append(sample_count)
+
+class FakeLv2Instance(FakeInstance):
+    """
+    Stands for lv2.Instance, without loading the plugin binary
+    """
+    instances = []
+
+    def __init__(self, plugin, sample_rate):
+        super(FakeLv2Instance, self).__init__()
+        self.plugin = plugin
+        self.sample_rate = sample_rate
+        self.cleaned = False
+        self.instances.append(self)
+
+    def run(self, sample_count):
+        assert self.active
+        self.runs.append(sample_count)
+
+    def cleanup(self):
+        self.cleaned = True
+
+GAIN = { '_id': u'abc123',
+         'url': u'http://example.org/plugins/gain',
+         'bufsize': 64,
+         'ports': { 'audio': { 'input': [ { 'index': 1 } ], 'output': [ { 'index': 2 } ] },
+                    'control': { 'input': [ { 'index': 0, 'default': 2.0 } ], 'output': [] },
+                    },
+         }
+
+class DspTest(unittest.TestCase):
+
+    def test_buffer_is_shared_with_pointer(self):
+        buf = dsp.float_buffer(4)
+        pointer = dsp.float_pointer(buf)
+        pointer[2] = 0.5
+        self.assertEquals(buf[2], 0.5)
+
+    def test_percentile(self):
+        values = range(101)
+        self.assertEquals(dsp.percentile(values, 50), 50)
+        self.assertEquals(dsp.percentile(values, 99), 99)
+        self.assertEquals(dsp.percentile([3], 90), 3)
+
+    def test_benchmark(self):
+        instance = FakeInstance()
+        results = dsp.benchmark(instance, [1], [2], {0: 2.0}, 48000,
+                                block_sizes=(16, 32), blocks=20, warmup=5)
+
+        self.assertEquals(instance.runs, [16] * 25 + [32] * 25)
+        self.assertFalse(instance.active)
+        self.assertAlmostEquals(instance.buffers[2][31], instance.buffers[1][31] * 2)
+
+        self.assertEquals([ r['block_size'] for r in results ], [16, 32])
+        for result in results:
+            self.assertEquals(result['blocks'], 20)
+            self.assertTrue(result['p50_us'] <= result['p90_us'] <= result['p99_us'] <= result['max_us'])
+            self.assertAlmostEquals(result['realtime_factor'],
+                                    result['mean_us'] / 1e6 * 48000 / result['block_size'])
+
+    def test_control_value(self):
+        self.assertEquals(dsp.control_value({'default': 3, 'minimum': 1}), 3)
+        self.assertEquals(dsp.control_value({'default': None, 'minimum': 1}), 1)
+        self.assertEquals(dsp.control_value({}), 0.0)
+
+class Lv2BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance_class = lv2.Instance
+        lv2.Instance = FakeLv2Instance
+        FakeLv2Instance.instances = []
+
+    def tearDown(self):
+        lv2.Instance = self.instance_class
+
+    def test_benchmark_lv2(self):
+        result = dsp.benchmark_lv2(GAIN, 44100, blocks=10, warmup=2)
+        self.assertEquals(sorted(result.keys()), ['_id', 'results', 'sample_rate', 'url'])
+        self.assertEquals(result['_id'], u'abc123')
+        self.assertEquals(result['url'], u'http://example.org/plugins/gain')
+        self.assertEquals(result['sample_rate'], 44100)
+        # plugin's bufsize by default
+        self.assertEquals([ r['block_size'] for r in result['results'] ], [64])
+        self.assertEquals(result['results'][0]['blocks'], 10)
+
+        instance = FakeLv2Instance.instances[0]
+        self.assertEquals(instance.sample_rate, 44100)
+        self.assertEquals(instance.buffers[0][0], 2.0)
+        self.assertTrue(instance.cleaned)
+
+        result = dsp.benchmark_lv2(GAIN, block_sizes=(16, 32), blocks=10, warmup=2)
+        self.assertEquals([ r['block_size'] for r in result['results'] ], [16, 32])
+
+    @attr(slow=1)
+    def test_lv2_command(self):
+        bundle = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calf.lv2')
+        url = 'http://calf.sourceforge.net/plugins/Reverb'
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            dsp.main(['--blocks', '5', 'lv2', bundle, url])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        result = json.loads(output)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0]['url'], url)
+        self.assertEquals([ r['block_size'] for r in result[0]['results'] ], [128])
+        self.assertEquals(FakeLv2Instance.instances[0].runs[-1], 128)
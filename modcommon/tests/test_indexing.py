@@ -0,0 +1,872 @@
+# -*- coding: utf-8
+
+import unittest, os, shutil, tempfile, json, gzip, atexit, threading
+from cStringIO import StringIO
+import tornado.gen
+import tornado.web
+from tornado.httpclient import HTTPError
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from modcommon import indexing
+from modcommon.indexing import EffectIndex, PedalboardIndex, EffectSearcher, PedalboardSearcher, get_index
+from whoosh.query import Every
+from whoosh.fields import Schema, ID, TEXT, NGRAMWORDS, STORED
+
+def effect(objid, name, **kwargs):
+    data = { '_id': objid,
+             'url': u'http://portalmod.com/plugins/%s' % objid,
+             'name': name,
+             'label': name,
+             'category': u'Delay',
+             'stability': u'stable',
+             'brand': u'MOD',
+             'ports': { 'audio': { 'input': [ {} ], 'output': [ {}, {} ] } },
+             }
+    data.update(kwargs)
+    return data
+
+def pedalboard(objid, title, plugins, connections=(), footswitches=0, rotaries=0):
+    addressing = {}
+    for i in range(footswitches):
+        addressing['switch%d' % i] = { 'actuator': [0, 0, 1, i] }
+    for i in range(rotaries):
+        addressing['knob%d' % i] = { 'actuator': [0, 0, 2, i] }
+    instances = [ { 'url': u'http://portalmod.com/plugins/%s' % plugin } for plugin in plugins ]
+    if instances:
+        instances[0]['addressing'] = addressing
+    return { '_id': objid,
+             'title': title,
+             'connections': [ list(connection) for connection in connections ],
+             'instances': instances,
+             }
+
+STEREO = [ ('system', 'capture_1', 'delay', 'in_l'), ('system', 'capture_2', 'delay', 'in_r') ]
+
+PEDALBOARDS = [
+    pedalboard(u'p1', u'Ambient', [u'delay', u'reverb'], STEREO, footswitches=3, rotaries=1),
+    pedalboard(u'p2', u'Echoes', [u'delay', u'delay'], STEREO, footswitches=2),
+    pedalboard(u'p3', u'Heavy metal', [u'fuzz'], STEREO[:1]),
+    ]
+
+class OldPedalboardIndex(PedalboardIndex):
+    # before hardware requirements and plugins were indexed
+    schema = Schema(id=ID(unique=True, stored=True),
+                    title=NGRAMWORDS(minsize=3, maxsize=5, stored=True),
+                    description=TEXT,
+                    json=STORED(),
+                    )
+
+class NoJsonPedalboardIndex(PedalboardIndex):
+    # before objects could be stored in index
+    schema = Schema(id=ID(unique=True, stored=True),
+                    title=NGRAMWORDS(minsize=3, maxsize=5, stored=True),
+                    description=TEXT,
+                    )
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'effects')
+
+    def tearDown(self):
+        indexing._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_effect_is_found(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator'))
+        index.add(effect(u'b2', u'Distortion', category=u'Distortion'))
+
+        entries = list(index.find(category=u'Delay'))
+        self.assertEquals(len(entries), 1)
+        self.assertEquals(entries[0]['id'], u'a1')
+        self.assertEquals(entries[0]['input_ports'], 1)
+        self.assertEquals(entries[0]['output_ports'], 2)
+
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), [u'a1', u'b2'])
+        self.assertEquals([ e['id'] for e in index.term_search({'term': [u'distortion']}) ], [u'b2'])
+        self.assertEquals([ e['id'] for e in index.every(limit=1, sortedby='category') ], [u'a1'])
+
+        self.assertTrue(index.delete(u'a1'))
+        self.assertEquals([ e['id'] for e in index.every() ], [u'b2'])
+
+    def test_index_is_shared(self):
+        index = get_index(EffectIndex, self.index_path)
+        self.assertTrue(get_index(EffectIndex, self.index_path + '/') is index)
+        self.assertRaises(Exception, get_index, PedalboardIndex, self.index_path)
+
+    def test_searcher_is_reused_until_index_changes(self):
+        index = get_index(EffectIndex, self.index_path)
+        searcher = index.searcher()
+        self.assertTrue(index.searcher() is searcher)
+
+        index.add(effect(u'a1', u'Reverberator'))
+        new_searcher = index.searcher()
+        self.assertFalse(new_searcher is searcher)
+        self.assertTrue(index.searcher() is new_searcher)
+        self.assertEquals([ e['id'] for e in index.every() ], [u'a1'])
+
+    def test_replaced_searcher_is_closed(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator'))
+        with index.searching() as searcher:
+            index.add(effect(u'a2', u'Distortion'))
+            self.assertFalse(index.searcher() is searcher)
+            # still in use
+            self.assertFalse(searcher.is_closed)
+            self.assertEquals(searcher.doc_count(), 1)
+        self.assertTrue(searcher.is_closed)
+
+        idle = index.searcher()
+        index.add(effect(u'a3', u'Chorus'))
+        self.assertFalse(index.searcher().is_closed)
+        self.assertTrue(idle.is_closed)
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), [u'a1', u'a2', u'a3'])
+
+    def test_add_many(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a0', u'Old name'))
+        generation = index.generation
+
+        effects = [ effect(u'a%d' % i, u'Effect %d' % i) for i in range(50) ]
+        self.assertEquals(index.add_many(iter(effects)), 50)
+
+        # a single commit
+        self.assertEquals(index.generation, generation + 1)
+        self.assertEquals(len(list(index.every())), 50)
+        self.assertEquals(list(index.find(id=u'a0'))[0]['name'], u'Effect 0')
+
+    def test_add_many_with_processes(self):
+        index = EffectIndex(self.index_path)
+        effects = [ effect(u'a%d' % i, u'Effect %d' % i) for i in range(20) ]
+        self.assertEquals(index.add_many(effects, procs=2, update=False, optimize=True), 20)
+        self.assertEquals(len(list(index.every())), 20)
+
+    def test_scores_are_buffered(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator', score=3))
+        generation = index.generation
+
+        for i in range(5):
+            index.scores.increment(effect(u'a1', u'Reverberator'))
+        index.scores.increment(effect(u'b2', u'Distortion'))
+        self.assertEquals(index.generation, generation)
+
+        self.assertEquals(index.scores.flush(), 2)
+        self.assertEquals(index.generation, generation + 1)
+        scores = dict([ (e['id'], e['score']) for e in index.every() ])
+        self.assertEquals(scores, {u'a1': 8, u'b2': 1})
+        self.assertEquals(index.scores.flush(), 0)
+
+    def test_due_scores_are_flushed_in_executor(self):
+        index = EffectIndex(self.index_path)
+        index.scores.max_pending = 2
+        threads = []
+        add_many = index.add_many
+        def record(effects):
+            threads.append(threading.current_thread())
+            return add_many(effects)
+        index.add_many = record
+
+        index.scores.increment(effect(u'a1', u'Reverberator'))
+        self.assertTrue(index.scores.scheduled is None)
+        index.scores.increment(effect(u'b2', u'Distortion'))
+        self.assertEquals(index.scores.scheduled.result(), 2)
+        self.assertFalse(threads[0] is threading.current_thread())
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), [u'a1', u'b2'])
+
+    def test_shared_indexes_are_flushed_at_exit(self):
+        handlers = len(atexit._exithandlers)
+        EffectIndex(os.path.join(self.tmp_dir, 'private'))
+        self.assertEquals(len(atexit._exithandlers), handlers)
+        index = get_index(EffectIndex, self.index_path)
+        get_index(EffectIndex, self.index_path)
+        self.assertEquals(len(atexit._exithandlers), handlers + 1)
+        self.assertEquals(atexit._exithandlers[-1][0], index.flush)
+
+    def test_scores_from_threads(self):
+        index = EffectIndex(self.index_path)
+        index.scores.max_pending = 2
+
+        def score(objid):
+            for i in range(20):
+                index.scores.increment(effect(objid, objid))
+        threads = [ threading.Thread(target=score, args=(u'a%d' % i,)) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        index.scores.flush()
+
+        self.assertEquals([ e['score'] for e in index.every() ], [20] * 4)
+
+    def test_concurrent_writers(self):
+        index = EffectIndex(self.index_path)
+        # writers of this process must wait for each other, not for the index lock
+        index.write_timeout = 0
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(5):
+                    objid = u'a%d' % (n * 10 + i)
+                    index.add(effect(objid, objid))
+                    index.scores.increment(effect(objid, objid))
+                    index.scores.flush()
+                    index.add_many([ effect(u'b%d' % n, u'B') ])
+                    index.delete(u'b%d' % n)
+                    index.optimize()
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=write, args=(n,)) for n in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+        self.assertEquals(len(list(index.every())), 20)
+        self.assertEquals([ e['score'] for e in index.every() ], [1] * 20)
+
+    def test_favorites(self):
+        index = EffectIndex(self.index_path)
+        index.favorites_capacity = 3
+        index.add_many([ effect(u'a%d' % i, u'Effect %d' % i, score=i) for i in range(6) ])
+
+        self.assertEquals([ e['id'] for e in index.favorites(4) ], [u'a5', u'a4', u'a3', u'a2'])
+        self.assertEquals([ e['id'] for e in index.favorites(10) ], [u'a5', u'a4', u'a3', u'a2', u'a1'])
+
+        # favorites are kept in memory and updated on changes
+        for i in range(5):
+            index.scores.increment(effect(u'a1', u'Effect 1'))
+        index.scores.flush()
+        index.delete(u'a4')
+        index.add(effect(u'a6', u'Effect 6', score=4))
+        self.assertEquals([ (e['id'], e['score']) for e in index.favorites(3) ],
+                          [(u'a1', 6), (u'a5', 5), (u'a6', 4)])
+
+    def test_favorites_follow_other_processes(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator', score=2))
+        self.assertEquals([ e['id'] for e in index.favorites() ], [u'a1'])
+        favorites = index._favorites
+
+        index.add(effect(u'a2', u'Distortion', score=3))
+        self.assertEquals([ e['id'] for e in index.favorites() ], [u'a2', u'a1'])
+        self.assertTrue(index._favorites is favorites)
+
+        other = EffectIndex(self.index_path)
+        other.add(effect(u'a3', u'Delay', score=5))
+        self.assertEquals([ e['id'] for e in index.favorites() ], [u'a3', u'a2', u'a1'])
+
+    def test_favorites_of_empty_index(self):
+        index = EffectIndex(self.index_path)
+        self.assertEquals(index.favorites(), [])
+        index.add(effect(u'a1', u'Effect'))
+        self.assertEquals(index.favorites(), [])
+
+    def test_autocomplete(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator', score=1))
+        index.add(effect(u'a2', u'Reverse Delay', score=5))
+        index.add(effect(u'a3', u'Distortion', category=u'Distortion'))
+
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'rev') ], [u'a2', u'a1'])
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'REVERSE del') ], [u'a2'])
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'dist') ], [u'a3'])
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'rev', limit=1) ], [u'a2'])
+        self.assertEquals(index.autocomplete(u'xyz'), [])
+        self.assertEquals(index.autocomplete(u''), [])
+
+        # trie is kept in sync with index
+        index.delete(u'a2')
+        index.add(effect(u'a4', u'Revolver'))
+        for i in range(3):
+            index.scores.increment(effect(u'a4', u'Revolver'))
+        index.scores.flush()
+        entries = index.autocomplete(u'rev')
+        self.assertEquals([ (e['id'], e['score']) for e in entries ], [(u'a4', 3), (u'a1', 1)])
+        self.assertEquals(entries[0]['name'], u'Revolver')
+        self.assertEquals(index.autocomplete(u'reverse'), [])
+
+    def test_autocomplete_of_lists(self):
+        trie = indexing.PrefixTrie(['name', 'category'])
+        trie.add({ 'id': u'a1', 'name': u'Echo', 'category': [u'Delay', u'Modulator'] })
+        self.assertEquals(trie.search(u'mod'), [{ 'id': u'a1', 'name': u'Echo', 'score': 0,
+                                                  'category': [u'Delay', u'Modulator'] }])
+        self.assertEquals(trie.search(u'u'), [])
+
+    def test_autocomplete_follows_other_processes(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator'))
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'rev') ], [u'a1'])
+        trie = index._autocomplete
+
+        # commits of this index update the trie
+        index.add(effect(u'a2', u'Reverse delay'))
+        self.assertEquals(len(index.autocomplete(u'rev')), 2)
+        self.assertTrue(index._autocomplete is trie)
+
+        # commits of another one are only in the index, so trie is built again
+        other = EffectIndex(self.index_path)
+        other.add(effect(u'a3', u'Revolver'))
+        self.assertEquals(len(index.autocomplete(u'rev')), 3)
+        self.assertFalse(index._autocomplete is trie)
+
+    def test_pedalboard_autocomplete(self):
+        index = PedalboardIndex(self.index_path)
+        index.add({ '_id': u'p1', 'title': u'Heavy metal', 'description': u'Distortion' })
+        index.add({ '_id': u'p2', 'title': u'Ambient', 'description': u'Heavy reverb' })
+        self.assertEquals(index.autocomplete(u'hea'), [{ 'id': u'p1', 'title': u'Heavy metal', 'score': 0 }])
+
+    def test_pedalboard_requirements_and_plugins(self):
+        index = PedalboardIndex(self.index_path)
+        index.add_many(PEDALBOARDS)
+
+        def search(**query):
+            return sorted([ e['id'] for e in index.term_search(query) ])
+        delay = u'http://portalmod.com/plugins/delay'
+        self.assertEquals(search(plugins=[delay]), [u'p1', u'p2'])
+        self.assertEquals(search(plugins=[delay], where=[u'footswitch_addressings<=2']), [u'p2'])
+        self.assertEquals(search(where=[u'audio_inputs>=2', u'rotary_addressings=0']), [u'p2'])
+        self.assertEquals(search(term=[u'heavy'], where=[u'plugins=http://portalmod.com/plugins/fuzz']),
+                          [u'p3'])
+        self.assertEquals([ e['id'] for e in index.every(sortedby='footswitch_addressings', reverse=True) ],
+                          [u'p1', u'p2', u'p3'])
+
+    def test_outdated_index(self):
+        OldPedalboardIndex(self.index_path).add_many(PEDALBOARDS + [ pedalboard(u'p9', u'Old', []) ])
+
+        index = PedalboardIndex(self.index_path)
+        self.assertEquals(index.outdated(), sorted(PedalboardIndex.sortable_fields + ['plugins']))
+        self.assertEquals(index.stats()['outdated'], index.outdated())
+        # new fields are not written, and can't be filtered by
+        index.add(pedalboard(u'p4', u'Clean', [u'reverb']))
+        self.assertEquals([ e['id'] for e in index.term_search({ 'term': [u'clean'] }) ], [u'p4'])
+        self.assertRaises(ValueError, index.term_search, { 'where': [u'footswitch_addressings<=2'] })
+        self.assertRaises(ValueError, index.term_search, { 'plugins': [u'http://portalmod.com/plugins/fuzz'] })
+        self.assertEquals(index.autocomplete(u'old'), [{ 'id': u'p9', 'title': u'Old', 'score': 0 }])
+
+        self.assertEquals(index.reindex(PEDALBOARDS), 3)
+        self.assertEquals(index.outdated(), [])
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), [u'p1', u'p2', u'p3'])
+        self.assertEquals([ e['id'] for e in index.term_search({ 'where': [u'footswitch_addressings<=2'],
+                                                                  'term': [u'heavy'] }) ], [u'p3'])
+        self.assertEquals(index.autocomplete(u'old'), [])
+        self.assertFalse(os.path.exists(self.index_path + '.old'))
+
+        index = PedalboardIndex(self.index_path)
+        self.assertEquals(index.outdated(), [])
+        self.assertEquals(len(list(index.term_search({ 'plugins': [u'http://portalmod.com/plugins/delay'] }))), 2)
+
+    def test_outdated_index_with_json_is_upgraded(self):
+        class OldJsonIndex(OldPedalboardIndex):
+            store_json = True
+        class JsonIndex(PedalboardIndex):
+            store_json = True
+        OldJsonIndex(self.index_path).add_many(PEDALBOARDS)
+
+        index = JsonIndex(self.index_path)
+        self.assertEquals(index.outdated(), [])
+        self.assertEquals(sorted([ e['id'] for e in index.term_search({ 'where': [u'audio_inputs>=2'] }) ]),
+                          [u'p1', u'p2'])
+        # objects are still stored
+        entry = index.hits(index.find_query(id=u'p3'), raw=True)[0]
+        self.assertEquals(json.loads(entry['json'])['title'], u'Heavy metal')
+
+    def test_index_without_json(self):
+        NoJsonPedalboardIndex(self.index_path).add_many(PEDALBOARDS)
+
+        # json field is only missing if objects are to be stored
+        index = PedalboardIndex(self.index_path)
+        self.assertFalse('json' in index.outdated())
+        class JsonIndex(PedalboardIndex):
+            store_json = True
+        index = JsonIndex(self.index_path)
+        self.assertTrue('json' in index.outdated())
+        self.assertFalse(index.upgrade())
+
+        # objects are not stored until it's reindexed
+        index.add(pedalboard(u'p4', u'Clean', [u'reverb']))
+        entry = index.hits(index.find_query(id=u'p4'), raw=True)[0]
+        self.assertFalse('json' in entry)
+        index.reindex(PEDALBOARDS)
+        self.assertEquals(index.outdated(), [])
+        entry = index.hits(index.find_query(id=u'p3'), raw=True)[0]
+        self.assertEquals(json.loads(entry['json'])['title'], u'Heavy metal')
+
+    def test_results_are_cached(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverberator'))
+        index.add(effect(u'a2', u'Distortion', category=u'Distortion'))
+
+        query = { 'term': [u'reverb'], 'category': [u'Reverb', u'Delay'] }
+        self.assertEquals([ e['id'] for e in index.term_search(query) ], [u'a1'])
+        query = { 'category': [u'Delay', u'Reverb'], 'term': [u'reverb'] }
+        entries = list(index.term_search(query))
+        self.assertEquals(index.cache.stats(), { 'size': 1, 'hits': 1, 'misses': 1 })
+
+        # copies are returned
+        entries[0]['name'] = u'Changed'
+        self.assertEquals(list(index.find(category=u'Delay'))[0]['name'], u'Reverberator')
+        self.assertEquals(list(index.find(category=u'Delay'))[0]['name'], u'Reverberator')
+        self.assertEquals(index.cache.hits, 2)
+
+        # commits invalidate cache
+        index.add(effect(u'a3', u'Reverb', category=u'Reverb'))
+        self.assertEquals(index.cache.stats()['size'], 0)
+        self.assertEquals(sorted([ e['id'] for e in index.term_search(query) ]), [u'a1', u'a3'])
+        self.assertEquals(index.cache.misses, 3)
+
+    def test_facets(self):
+        index = EffectIndex(self.index_path)
+        index.add(effect(u'a1', u'Reverb', category=u'Reverb'))
+        index.add(effect(u'a2', u'Delay'))
+        index.add(effect(u'a3', u'Mono delay', brand=u'Other',
+                         ports={ 'audio': { 'input': [ {} ], 'output': [ {} ] } }))
+
+        result = index.facets(Every(), ['category', 'brand', 'output_ports'])
+        self.assertEquals(result['total'], 3)
+        self.assertEquals(result['facets'], { 'category': [[u'Delay', 2], [u'Reverb', 1]],
+                                              'brand': [[u'MOD', 2], [u'Other', 1]],
+                                              'output_ports': [[2, 2], [1, 1]],
+                                              })
+
+    def test_predicates(self):
+        schema = EffectIndex.schema
+        self.assertEquals(indexing.parse_predicate(u'input_ports<=2', schema), ('input_ports', '<=', [2]))
+        # fractional bounds on integer fields
+        self.assertEquals(indexing.parse_predicate(u'score > 1.5', schema), ('score', '>=', [2]))
+        self.assertEquals(indexing.parse_predicate(u'score >= 1.5', schema), ('score', '>=', [2]))
+        self.assertEquals(indexing.parse_predicate(u'score < 1.5', schema), ('score', '<=', [1]))
+        self.assertEquals(indexing.parse_predicate(u'score <= -1.5', schema), ('score', '<=', [-2]))
+        self.assertEquals(indexing.parse_predicate(u"stability in (stable, 'testing')", schema),
+                          ('stability', 'in', [u'stable', u'testing']))
+        for expression in (u'input_ports<=x', u'name=reverb', u'stability<stable', u'foo=1',
+                           u'brand in ()', u'brand in MOD', u'input_ports', u'score<inf',
+                           u'score>-1e400', u'score=nan', u'score=1.5', u'score in (1, 2.5)',
+                           u'score<1e20'):
+            self.assertRaises(ValueError, indexing.parse_predicate, expression, schema)
+
+        index = EffectIndex(self.index_path)
+        mono = { 'audio': { 'input': [ {} ], 'output': [ {} ] } }
+        index.add_many([ effect(u'a1', u'Mono', ports=mono),
+                         effect(u'a2', u'Stereo', stability=u'testing'),
+                         effect(u'a3', u'Quad', stability=u'experimental',
+                                ports={ 'audio': { 'input': [ {} ] * 4, 'output': [ {} ] * 4 } }) ])
+
+        def ids(*expressions):
+            return sorted([ e['id'] for e in index.term_search({ 'where': list(expressions) }) ])
+        self.assertEquals(ids(u'output_ports<=2'), [u'a1', u'a2'])
+        self.assertEquals(ids(u'output_ports<2'), [u'a1'])
+        self.assertEquals(ids(u'output_ports>=2', u'input_ports>1'), [u'a3'])
+        self.assertEquals(ids(u'output_ports in (1, 4)'), [u'a1', u'a3'])
+        self.assertEquals(ids(u'stability in (stable, testing)'), [u'a1', u'a2'])
+        self.assertEquals(ids(u'stability=testing'), [u'a2'])
+
+    def test_maintenance(self):
+        index = EffectIndex(self.index_path)
+        for i in range(3):
+            index.add_many([ effect(u'a%d%d' % (i, j), u'Effect') for j in range(4) ], merge=False)
+        objects = dict([ (u'a%d%d' % (i, j), {}) for i in range(3) for j in range(2) ])
+        lookups = []
+        def get_objects(objids):
+            lookups.append(len(objids))
+            return dict([ (objid, objects[objid]) for objid in objids if objid in objects ])
+
+        maintenance = indexing.Maintenance(index, get_objects, max_segments=2, batch_size=5, max_purge=0.5)
+        report = maintenance.run()
+        self.assertEquals(lookups, [5, 5, 2])
+        self.assertEquals(report['purged'], 6)
+        self.assertFalse(report['purge_aborted'])
+        self.assertTrue(report['optimized'])
+        self.assertEquals(report['before']['documents'], 12)
+        self.assertEquals(report['before']['segments'], 3)
+        self.assertEquals(report['after']['documents'], 6)
+        self.assertEquals(report['after']['segments'], 1)
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), sorted(objects.keys()))
+
+        report = maintenance.run()
+        self.assertEquals(report['purged'], 0)
+        self.assertFalse(report['optimized'])
+
+    def test_maintenance_purge_limit(self):
+        index = EffectIndex(self.index_path)
+        index.add_many([ effect(u'a%d' % i, u'Effect') for i in range(8) ])
+
+        # database is down
+        report = indexing.Maintenance(index, lambda objids: {}).run()
+        self.assertTrue(report['purge_aborted'])
+        self.assertEquals(report['orphans'], 8)
+        self.assertEquals(report['purged'], 0)
+        self.assertEquals(report['after']['documents'], 8)
+
+        objects = dict([ (u'a%d' % i, {}) for i in range(6) ])
+        report = indexing.Maintenance(index, lambda objids: objects).run()
+        self.assertFalse(report['purge_aborted'])
+        self.assertEquals(report['purged'], 2)
+        # a quarter of documents were deleted
+        self.assertTrue(report['optimized'])
+        self.assertEquals(report['after']['deleted'], 0)
+
+    def test_maintenance_deleted_ratio(self):
+        index = EffectIndex(self.index_path)
+        index.add_many([ effect(u'a%d' % i, u'Effect') for i in range(10) ])
+        maintenance = indexing.Maintenance(index, lambda objids: {}, max_deleted=0.2)
+
+        index.delete_many([u'a0', u'a1'])
+        report = maintenance.run()
+        self.assertFalse(report['optimized'])
+        self.assertEquals(report['after']['deleted'], 2)
+
+        index.delete(u'a2')
+        report = maintenance.run()
+        self.assertTrue(report['optimized'])
+        self.assertEquals(report['after']['deleted'], 0)
+        self.assertEquals(report['after']['documents'], 7)
+
+    def test_stats(self):
+        index = EffectIndex(self.index_path)
+        index.add_many([ effect(u'a%d' % i, u'Effect') for i in range(3) ])
+        index.add(effect(u'b1', u'Effect'))
+        index.delete(u'a1')
+        stats = index.stats()
+        self.assertEquals(stats['documents'], 3)
+        self.assertEquals(stats['deleted'], 1)
+        self.assertEquals(stats['segments'], 2)
+
+    def test_histogram(self):
+        histogram = indexing.Histogram((1, 10, 100))
+        for value in (0.5, 1, 2, 3, 50, 500):
+            histogram.add(value)
+        result = histogram.dump()
+        self.assertEquals(result['count'], 6)
+        self.assertEquals(result['max'], 500)
+        self.assertEquals(result['buckets'], [[1, 2], [10, 2], [100, 1], [None, 1]])
+        self.assertEquals(result['p50'], 10)
+        self.assertEquals(result['p99'], 500)
+
+    def test_metrics(self):
+        index = EffectIndex(self.index_path)
+        index.add_many([ effect(u'a%d' % i, u'Effect %d' % i) for i in range(3) ])
+        index.delete(u'a2')
+        list(index.term_search({ 'term': [u'effect'] }))
+        list(index.find(category=u'Delay'))
+        self.assertEquals(index.find(category=u'Delay').next()['category'], u'Delay')
+
+        result = json.loads(json.dumps(index.metrics.dump()))
+        self.assertEquals(sorted(result['latency'].keys()),
+                          ['add_many', 'commit', 'delete', 'find', 'term_search'])
+        self.assertEquals(result['latency']['commit']['count'], 2)
+        self.assertEquals(result['latency']['find']['count'], 2)
+        self.assertEquals(result['results']['term_search']['max'], 2)
+        index.metrics.reset()
+        self.assertEquals(index.metrics.dump()['latency'], {})
+
+
+class SearcherTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.objects = {}
+        self.lookups = []
+        super(SearcherTest, self).setUp()
+
+    def tearDown(self):
+        super(SearcherTest, self).tearDown()
+        indexing.setup_executor()
+        indexing._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def get_app(self):
+        test = self
+
+        class Searcher(EffectSearcher):
+            index_path = os.path.join(self.tmp_dir, 'effects')
+
+            def get_object(self, objid):
+                test.lookups.append([objid])
+                return test.objects.get(objid)
+
+        self.searcher_class = Searcher
+        return tornado.web.Application(Searcher.urls('effect'))
+
+    @property
+    def index(self):
+        return get_index(EffectIndex, self.searcher_class.index_path)
+
+    def add(self, *effects):
+        for data in effects:
+            self.index.add(data)
+            self.objects[data['_id']] = { 'extra': data['_id'].upper() }
+
+    def get_json(self, url):
+        response = self.fetch(url)
+        self.assertEquals(response.code, 200)
+        return json.loads(response.body)
+
+    def test_search_merges_objects(self):
+        self.add(effect(u'a1', u'Reverberator'), effect(u'b2', u'Reverse delay'))
+        # an entry without object is skipped
+        self.index.add(effect(u'c3', u'Reverb garbage'))
+
+        result = self.get_json('/effect/search/?term=rev')
+        self.assertEquals(sorted([ (e['id'], e['extra']) for e in result ]),
+                          [(u'a1', u'A1'), (u'b2', u'B2')])
+
+    def test_objects_are_fetched_at_once(self):
+        self.add(effect(u'a1', u'Reverberator'), effect(u'b2', u'Reverse delay'))
+        test = self
+
+        class Searcher(self.searcher_class):
+            def get_objects(self, objids):
+                test.lookups.append(sorted(objids))
+                return dict([ (objid, test.objects[objid]) for objid in objids ])
+        self._app.add_handlers('.*', Searcher.urls('batch'))
+
+        self.assertEquals(len(self.get_json('/batch/list/')), 2)
+        self.assertEquals(self.lookups, [[u'a1', u'b2']])
+
+    def test_search_page(self):
+        self.add(*[ effect(u'a%d' % i, u'Reverb %d' % i, score=i) for i in range(25) ])
+
+        page = self.get_json('/effect/search/?term=reverb&page=2&pagelen=10&sort=score&reverse=1')
+        self.assertEquals(page['total'], 25)
+        self.assertEquals(page['page'], 2)
+        self.assertEquals(page['pagecount'], 3)
+        self.assertEquals([ e['score'] for e in page['results'] ], range(14, 4, -1))
+        self.assertEquals(page['results'][0]['extra'], u'A14')
+
+        page = self.get_json('/effect/list/?page=3&pagelen=10&sort=score')
+        self.assertEquals([ e['score'] for e in page['results'] ], range(20, 25))
+
+    def test_search_limit(self):
+        self.add(*[ effect(u'a%d' % i, u'Reverb %d' % i, score=i) for i in range(25) ])
+        result = self.get_json('/effect/search/?term=reverb&limit=3&sort=score&reverse=true')
+        self.assertEquals(result['total'], 25)
+        self.assertEquals(result['limit'], 3)
+        self.assertEquals([ e['id'] for e in result['results'] ], [u'a24', u'a23', u'a22'])
+
+    def test_search_filters(self):
+        self.add(effect(u'a1', u'Reverb', category=u'Reverb'),
+                 effect(u'a2', u'Reverb delay'),
+                 effect(u'a3', u'Big reverb', category=u'Reverb', brand=u'Other'))
+        result = self.get_json('/effect/search/?term=reverb&category=Reverb&brand=MOD&page=1')
+        self.assertEquals([ e['id'] for e in result['results'] ], [u'a1'])
+
+    def test_search_where(self):
+        self.add(effect(u'a1', u'Reverb', ports={ 'audio': { 'input': [ {} ], 'output': [ {} ] } }),
+                 effect(u'a2', u'Reverb delay'))
+        result = self.get_json('/effect/search/?term=reverb&where=output_ports%3C2')
+        self.assertEquals([ e['id'] for e in result ], [u'a1'])
+        self.assertEquals(self.fetch('/effect/search/?term=reverb&where=name%3C2').code, 400)
+        self.assertEquals(self.fetch('/effect/search/?where=output_ports%3Cinf').code, 400)
+        self.assertEquals(self.fetch('/effect/search/?where=output_ports%3C1e400').code, 400)
+
+    def test_etag(self):
+        self.add(effect(u'a1', u'Reverb'))
+        response = self.fetch('/effect/autocomplete/?term=rev')
+        etag = response.headers['Etag']
+        self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+
+        response = self.fetch('/effect/autocomplete/?term=rev', headers={ 'If-None-Match': etag })
+        self.assertEquals(response.code, 304)
+
+        response = self.fetch('/effect/autocomplete/?term=reverb', headers={ 'If-None-Match': etag })
+        self.assertEquals(response.code, 200)
+        self.assertNotEquals(response.headers['Etag'], etag)
+
+        self.add(effect(u'a2', u'Reverb delay'))
+        response = self.fetch('/effect/autocomplete/?term=rev', headers={ 'If-None-Match': etag })
+        self.assertEquals(response.code, 200)
+        self.assertEquals(len(json.loads(response.body)), 2)
+
+    def test_etag_of_merged_objects(self):
+        self.add(effect(u'a1', u'Reverb'))
+        # objects may change without the index changing
+        response = self.fetch('/effect/search/?term=reverb')
+        self.assertFalse('Etag' in response.headers)
+        self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+
+        test = self
+        test.version = 1
+        class Searcher(self.searcher_class):
+            def objects_version(self):
+                return test.version
+        self._app.add_handlers('.*', Searcher.urls('versioned'))
+
+        response = self.fetch('/versioned/search/?term=reverb')
+        etag = response.headers['Etag']
+        self.assertEquals(len(self.lookups), 2)
+        response = self.fetch('/versioned/search/?term=reverb', headers={ 'If-None-Match': etag })
+        self.assertEquals(response.code, 304)
+        self.assertEquals(len(self.lookups), 2)
+
+        test.version = 2
+        response = self.fetch('/versioned/search/?term=reverb', headers={ 'If-None-Match': etag })
+        self.assertEquals(response.code, 200)
+        self.assertEquals(len(self.lookups), 3)
+
+    def test_gzip(self):
+        self.add(*[ effect(u'a%d' % i, u'Reverb %d' % i) for i in range(20) ])
+        headers = { 'Accept-Encoding': 'gzip' }
+        response = self.fetch('/effect/list/', headers=headers, decompress_response=False)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO(response.body)).read()
+        self.assertEquals(len(json.loads(body)), 20)
+
+        response = self.fetch('/effect/list/?limit=1', headers=headers, decompress_response=False)
+        self.assertFalse('Content-Encoding' in response.headers)
+        response = self.fetch('/effect/list/', decompress_response=False)
+        self.assertFalse('Content-Encoding' in response.headers)
+
+    def test_outdated_index(self):
+        OldPedalboardIndex(os.path.join(self.tmp_dir, 'pedalboards')).add_many(PEDALBOARDS)
+
+        class Searcher(PedalboardSearcher):
+            index_path = os.path.join(self.tmp_dir, 'pedalboards')
+
+            def get_object(self, objid):
+                return {}
+        self._app.add_handlers('.*', Searcher.urls('pedalboard'))
+
+        self.assertEquals(len(self.get_json('/pedalboard/search/?term=heavy')), 1)
+        for url in ('/pedalboard/search/?where=footswitch_addressings%3C%3D2',
+                    '/pedalboard/search/?plugins=http://portalmod.com/plugins/fuzz',
+                    '/pedalboard/list/?sort=audio_inputs'):
+            self.assertEquals(self.fetch(url).code, 400)
+
+    def test_metrics(self):
+        self.add(effect(u'a1', u'Reverb'))
+        self.get_json('/effect/search/?term=reverb')
+        self.get_json('/effect/search/?term=reverb')
+        self.fetch('/effect/list/?page=0')
+
+        result = self.get_json('/effect/metrics/')
+        self.assertEquals(result['index']['documents'], 1)
+        self.assertEquals(result['cache']['hits'], 1)
+        metrics = result['metrics']
+        self.assertEquals(metrics['latency']['action.search']['count'], 2)
+        self.assertEquals(metrics['counters'], { 'status.200': 2, 'status.400': 1 })
+        self.assertFalse('Etag' in self.fetch('/effect/metrics/').headers)
+
+    def test_stored_json(self):
+        class JsonIndex(EffectIndex):
+            store_json = True
+
+        class Searcher(self.searcher_class):
+            index_class = JsonIndex
+            index_path = os.path.join(self.tmp_dir, 'json')
+        self._app.add_handlers('.*', Searcher.urls('json'))
+
+        # objects are what was indexed, as they would be in production
+        effects = [ effect(u'a%d' % i, u'Reverb %d' % i, score=i) for i in range(3) ]
+        self.index.add_many(effects)
+        self.objects = dict([ (data['_id'], data) for data in effects ])
+        index = get_index(JsonIndex, Searcher.index_path)
+        index.add_many(effects)
+        self.assertFalse('json' in list(index.every())[0])
+
+        for url in ('/%s/search/?term=reverb&sort=score', '/%s/list/?page=1&pagelen=2&sort=score'):
+            expected = self.get_json(url % 'effect')
+            lookups = len(self.lookups)
+            result = self.get_json(url % 'json')
+            self.assertEquals(result, json.loads(json.dumps(expected)))
+            self.assertEquals(len(self.lookups), lookups)
+            # responses come only from index
+            self.assertTrue('Etag' in self.fetch(url % 'json').headers)
+
+        self.assertEquals(indexing.encode_response(indexing.Fragments()), '[]')
+
+    def test_stored_json_in_index_without_json(self):
+        class JsonIndex(PedalboardIndex):
+            store_json = True
+
+        class Searcher(PedalboardSearcher):
+            index_class = JsonIndex
+            index_path = os.path.join(self.tmp_dir, 'nojson')
+
+            def get_object(self, objid):
+                return {}
+        self._app.add_handlers('.*', Searcher.urls('nojson'))
+        NoJsonPedalboardIndex(Searcher.index_path).add_many(PEDALBOARDS)
+
+        # responses are merged with objects, which can change without index changing
+        response = self.fetch('/nojson/search/?term=heavy')
+        self.assertEquals(len(json.loads(response.body)), 1)
+        self.assertFalse('Etag' in response.headers)
+
+    def test_invalid_paging(self):
+        self.assertEquals(self.fetch('/effect/list/?page=0').code, 400)
+        self.assertEquals(self.fetch('/effect/list/?page=x').code, 400)
+        self.assertEquals(self.fetch('/effect/list/?page=1&sort=name').code, 400)
+
+    def test_autocomplete(self):
+        self.add(effect(u'a1', u'Reverberator', score=1), effect(u'a2', u'Reverse delay', score=2))
+        result = self.get_json('/effect/autocomplete/?term=rev')
+        self.assertEquals([ e['id'] for e in result ], [u'a2', u'a1'])
+        self.assertEquals(len(self.get_json('/effect/autocomplete/?term=rev&limit=1')), 1)
+        self.assertEquals(self.fetch('/effect/autocomplete/').code, 400)
+
+    def test_facets(self):
+        self.add(effect(u'a1', u'Reverb', category=u'Reverb'),
+                 effect(u'a2', u'Reverse delay', stability=u'testing'),
+                 effect(u'a3', u'Big reverb', category=u'Reverb', brand=u'Other'))
+
+        result = self.get_json('/effect/facets/?term=rev&brand=MOD')
+        self.assertEquals(result['total'], 2)
+        self.assertEquals(sorted(result['facets'].keys()),
+                          ['brand', 'category', 'input_ports', 'output_ports', 'stability'])
+        self.assertEquals(result['facets']['category'], [[u'Delay', 1], [u'Reverb', 1]])
+        self.assertEquals(result['facets']['stability'], [[u'stable', 1], [u'testing', 1]])
+
+        result = self.get_json('/effect/facets/?facet=category&facet=input_ports&page=1')
+        self.assertEquals(result['facets'], { 'category': [[u'Reverb', 2], [u'Delay', 1]],
+                                              'input_ports': [[1, 3]] })
+        self.assertEquals(self.fetch('/effect/facets/?facet=description').code, 400)
+
+    @gen_test
+    def test_concurrency_limit(self):
+        indexing.setup_executor(workers=4, concurrency=1)
+        self.add(effect(u'a1', u'Reverberator'), effect(u'b2', u'Reverse delay'))
+        test = self
+        running = []
+        self.concurrent = 0
+
+        class Searcher(self.searcher_class):
+            def get_object(self, objid):
+                running.append(objid)
+                test.concurrent = max(test.concurrent, len(running))
+                threading.Event().wait(0.05)
+                running.remove(objid)
+                return test.objects.get(objid)
+        self._app.add_handlers('.*', Searcher.urls('slow'))
+
+        responses = yield [ self.http_client.fetch(self.get_url('/slow/list/')) for i in range(4) ]
+        self.assertEquals([ len(json.loads(r.body)) for r in responses ], [2] * 4)
+        self.assertEquals(self.concurrent, 1)
+
+    @gen_test
+    def test_request_is_dropped_when_client_goes_away(self):
+        indexing.setup_executor(concurrency=1)
+        self.add(effect(u'a1', u'Reverberator'), effect(u'b2', u'Reverse delay'))
+        release = threading.Event()
+
+        class Searcher(self.searcher_class):
+            def get_object(self, objid):
+                release.wait(5)
+                return super(Searcher, self).get_object(objid)
+        self._app.add_handlers('.*', Searcher.urls('slow'))
+
+        first = self.http_client.fetch(self.get_url('/slow/get/a1'))
+        yield tornado.gen.sleep(0.1)
+        try:
+            yield self.http_client.fetch(self.get_url('/slow/get/b2'), request_timeout=0.2)
+        except HTTPError, e:
+            self.assertEquals(e.code, 599)
+        yield tornado.gen.sleep(0.2)
+        release.set()
+
+        response = yield first
+        self.assertEquals(json.loads(response.body), { 'extra': u'A1' })
+        self.assertEquals(self.lookups, [[u'a1']])
@@ -1,7 +1,52 @@
 # -*- coding: utf-8
 
-import unittest, os
-from modcommon.ladspa import Plugin
+import unittest, os, sys, json, shutil, tempfile, subprocess
+from modcommon.ladspa import Plugin, Library, Scanner, scan_isolated
+
+# A library with two plugins, the second one with latin-1 strings
+LIBRARY_SOURCE = r"""
+typedef struct { int hint; float lower; float upper; } Hint;
+typedef struct {
+    unsigned long id;
+    const char *label;
+    int properties;
+    const char *name;
+    const char *maker;
+    const char *copyright;
+    unsigned long port_count;
+    const int *port_descriptors;
+    const char * const *port_names;
+    const Hint *port_hints;
+    void *functions[9];
+} Descriptor;
+
+static const int ports[] = { 0x9, 0xA, 0x5 };
+static const char * const names[] = { "in", "out", "gain" };
+static const Hint hints[] = { { 0, 0, 0 }, { 0, 0, 0 }, { 0x243, 0, 2 } };
+
+static const Descriptor descriptors[] = {
+    { 1001, "gain", 0, "Gain", "MOD", "GPL", 3, ports, names, hints },
+    { 1002, "cafe", 0, "Caf\xe9", "Jos\xe9", "GPL", 2, ports, names, hints },
+};
+
+const Descriptor *ladspa_descriptor(unsigned long index) {
+    return index < 2 ? &descriptors[index] : 0;
+}
+"""
+
+def compile_library(directory, name='plugins.so'):
+    """
+    Compiles LIBRARY_SOURCE into directory, skipping test if there's no compiler
+    """
+    source = os.path.join(directory, 'plugins.c')
+    path = os.path.join(directory, name)
+    open(source, 'w').write(LIBRARY_SOURCE)
+    try:
+        subprocess.check_call(['gcc', '-shared', '-fPIC', '-o', path, source])
+    except (OSError, subprocess.CalledProcessError):
+        raise unittest.SkipTest("gcc is needed to compile test library")
+    os.remove(source)
+    return path
 
 class PluginTest(unittest.TestCase):
 
@@ -91,3 +136,151 @@ class PluginTest(unittest.TestCase):
         self.assertTrue(port['maximum'] is None)
         self.assertTrue(port['default'] is None)
 
+
+class ScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.lib_path = os.path.join(self.tmp_dir, 'broken.so')
+        open(self.lib_path, 'w').write('not a library')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_broken_library_is_reported(self):
+        scanner = Scanner()
+        self.assertEquals(scanner.scan(self.tmp_dir), {})
+        self.assertEquals(scanner.errors.keys(), [self.lib_path])
+
+    def test_broken_library_is_reported_by_worker(self):
+        result = scan_isolated([self.lib_path], processes=1, timeout=30)
+        self.assertEquals(result.keys(), [self.lib_path])
+        self.assertFalse(result[self.lib_path]['ok'])
+        self.assertTrue(result[self.lib_path]['error'])
+
+        scanner = Scanner()
+        self.assertEquals(scanner.scan(self.tmp_dir, isolated=True), {})
+        self.assertEquals(scanner.errors.keys(), [self.lib_path])
+
+    def test_cached_library_is_not_loaded(self):
+        scanner = Scanner()
+        st = os.stat(self.lib_path)
+        scanner.cache[self.lib_path] = { 'size': st.st_size,
+                                         'mtime': st.st_mtime,
+                                         'plugins': [{'label': 'cached'}],
+                                         }
+        self.assertEquals(scanner.scan(self.tmp_dir), {self.lib_path: [{'label': 'cached'}]})
+        self.assertEquals(scanner.errors, {})
+
+        # Changed libraries are loaded again
+        open(self.lib_path, 'a').write('changed')
+        self.assertEquals(scanner.scan(self.tmp_dir), {})
+        self.assertEquals(scanner.errors.keys(), [self.lib_path])
+
+    def test_cache_file(self):
+        cache_file = os.path.join(self.tmp_dir, 'cache.json')
+        scanner = Scanner(cache_file)
+        st = os.stat(self.lib_path)
+        scanner.cache[self.lib_path] = { 'size': st.st_size,
+                                         'mtime': st.st_mtime,
+                                         'plugins': [{'label': 'cached'}],
+                                         }
+        scanner.save()
+
+        self.assertEquals(Scanner(cache_file).scan(self.tmp_dir), {self.lib_path: [{'label': 'cached'}]})
+
+    def test_removed_libraries_are_pruned_from_cache(self):
+        scanner = Scanner()
+        removed = os.path.join(self.tmp_dir, 'removed.so')
+        elsewhere = '/elsewhere/lib.so'
+        for path in (removed, elsewhere):
+            scanner.cache[path] = { 'size': 0, 'mtime': 0, 'plugins': [] }
+        scanner.errors[removed] = 'failed'
+        scanner.scan(self.tmp_dir)
+        self.assertEquals(sorted(scanner.cache.keys()), [elsewhere])
+        self.assertEquals(scanner.errors.keys(), [self.lib_path])
+
+
+class LibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.lib_path = compile_library(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_plugins_are_extracted(self):
+        descriptors = Library(self.lib_path).descriptors
+        self.assertEquals([ d['label'] for d in descriptors ], [u'gain', u'cafe'])
+        self.assertEquals([ d['index'] for d in descriptors ], [0, 1])
+        self.assertEquals(len(descriptors[0]['ports']['control']['input']), 1)
+        port = descriptors[0]['ports']['control']['input'][0]
+        self.assertEquals(port['name'], u'gain')
+        self.assertAlmostEquals(port['default'], 1)
+        self.assertEquals(len(descriptors[1]['ports']['control']['input']), 0)
+
+    def test_strings_are_decoded(self):
+        descriptor = Library(self.lib_path).descriptors[1]
+        self.assertEquals(descriptor['name'], u'Caf\xe9')
+        self.assertEquals(descriptor['author'], u'Jos\xe9')
+        self.assertTrue(isinstance(descriptor['ports']['audio']['input'][0]['name'], unicode))
+
+    def test_scan_saves_decoded_strings(self):
+        cache_file = os.path.join(self.tmp_dir, 'cache.json')
+        for isolated in (False, True):
+            result = Scanner(cache_file).scan(self.tmp_dir, isolated=isolated)
+            self.assertEquals([ d['name'] for d in result[self.lib_path] ], [u'Gain', u'Caf\xe9'])
+            cached = json.load(open(cache_file))
+            self.assertEquals(cached[self.lib_path]['plugins'][1]['author'], u'Jos\xe9')
+            os.remove(cache_file)
+
+
+# Fake worker, which hangs or kills itself for some libraries
+FAKE_WORKER = """
+import os, sys, json, time, signal
+for line in iter(sys.stdin.readline, ''):
+    name = os.path.basename(line.strip())
+    if name == 'hang.so':
+        time.sleep(60)
+    if name == 'crash.so':
+        os.kill(os.getpid(), signal.SIGKILL)
+    sys.stdout.write(json.dumps({ 'ok': True, 'plugins': [{ 'pid': os.getpid() }] }) + '\\n')
+    sys.stdout.flush()
+"""
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        script = os.path.join(self.tmp_dir, 'worker.py')
+        open(script, 'w').write(FAKE_WORKER)
+        self.command = [sys.executable, script]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def scan(self, names, **kwargs):
+        return scan_isolated([ '/plugins/%s' % name for name in names ],
+                             command=self.command, **kwargs)
+
+    def pid(self, status):
+        self.assertTrue(status['ok'])
+        return status['plugins'][0]['pid']
+
+    def test_workers_are_reused(self):
+        result = self.scan(['a.so', 'b.so', 'c.so'], processes=1)
+        self.assertEquals(len(set(self.pid(status) for status in result.values())), 1)
+
+    def test_hanging_worker_is_killed(self):
+        result = self.scan(['hang.so', 'a.so'], processes=1, timeout=1)
+        self.assertEquals(result['/plugins/hang.so'],
+                          { 'ok': False, 'error': u'Timeout after 1 seconds' })
+        self.assertTrue(self.pid(result['/plugins/a.so']))
+
+    def test_crashed_worker_is_replaced(self):
+        result = self.scan(['a.so', 'crash.so', 'b.so', 'c.so'], processes=1)
+        self.assertEquals(result['/plugins/crash.so'],
+                          { 'ok': False, 'error': u'Crashed with signal 9' })
+        self.assertNotEqual(self.pid(result['/plugins/a.so']), self.pid(result['/plugins/b.so']))
+        self.assertEquals(self.pid(result['/plugins/b.so']), self.pid(result['/plugins/c.so']))
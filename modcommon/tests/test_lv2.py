@@ -1,8 +1,8 @@
 # -*- coding: utf-8
 
-import unittest, os, random, shutil, subprocess
+import unittest, os, random, shutil, subprocess, ctypes
 from nose.plugins.attrib import attr
-from modcommon.lv2 import Bundle, BundlePackage
+from modcommon.lv2 import Bundle, BundlePackage, Instance, UridMap, Lv2UridMap, Lv2AtomSequence
 
 ROOT = os.path.dirname(os.path.realpath(__file__))
 
@@ -141,7 +141,9 @@ class BundleTest(unittest.TestCase):
         self.assertEquals(len(plugin['ports']['midi']['input']), 2)
         self.assertEquals(plugin['ports']['midi']['input'][0]['symbol'], 'event_in')
         self.assertEquals(plugin['ports']['midi']['input'][0]['name'], 'Event Midi')
+        self.assertEquals(plugin['ports']['midi']['input'][0]['type'], 'event')
         self.assertEquals(plugin['ports']['midi']['input'][1]['symbol'], 'atom_in')
+        self.assertEquals(plugin['ports']['midi']['input'][1]['type'], 'atom')
 
     @attr(slow=1)
     def test_bundle_id(self):
@@ -245,3 +247,87 @@ class BundlePackageTest(unittest.TestCase):
         finally:
             os.chdir(cur_dir)
             shutil.rmtree(tmp_dir)
+
+class FakeFunctions(object):
+    """
+    Plugin functions of a descriptor, recording calls
+    """
+    activate = deactivate = None
+
+    def __init__(self):
+        self.connected = {}
+        self.runs = []
+
+    def connect_port(self, handle, port, address):
+        self.connected[port] = address
+
+    def run(self, handle, sample_count):
+        self.runs.append(sample_count)
+
+    def cleanup(self, handle):
+        pass
+
+class InstanceTest(unittest.TestCase):
+
+    def test_urid_map(self):
+        urid_map = UridMap()
+        sequence = urid_map.map('http://lv2plug.in/ns/ext/atom#Sequence')
+        chunk = urid_map.map('http://lv2plug.in/ns/ext/atom#Chunk')
+        self.assertTrue(sequence > 0 and chunk > 0 and sequence != chunk)
+        self.assertEquals(urid_map.map('http://lv2plug.in/ns/ext/atom#Sequence'), sequence)
+        self.assertEquals(urid_map.unmap(chunk), 'http://lv2plug.in/ns/ext/atom#Chunk')
+        self.assertTrue(urid_map.unmap(chunk + 100) is None)
+
+        # as plugins call it, through the feature data
+        self.assertEquals(urid_map.feature.URI, 'http://lv2plug.in/ns/ext/urid#map')
+        feature = ctypes.cast(urid_map.feature.data, ctypes.POINTER(Lv2UridMap)).contents
+        self.assertEquals(feature.map(None, 'http://lv2plug.in/ns/ext/atom#Chunk'), chunk)
+        urid = feature.map(None, 'http://lv2plug.in/ns/ext/atom#Float')
+        self.assertEquals(urid_map.unmap(urid), 'http://lv2plug.in/ns/ext/atom#Float')
+        self.assertEquals(urid_map.map('http://lv2plug.in/ns/ext/atom#Float'), urid)
+
+    def test_atom_sequences(self):
+        instance = Instance.__new__(Instance)
+        instance.handle = 1
+        instance.active = False
+        instance.buffers = {}
+        instance.atom_outputs = []
+        instance.functions = FakeFunctions()
+
+        seq = instance.connect_atom(3, 7)
+        address = instance.functions.connected[3]
+        self.assertEquals(address, ctypes.addressof(instance.buffers[3]))
+        self.assertEquals(len(instance.buffers[3]), instance.atom_capacity)
+        header = Lv2AtomSequence.from_address(address)
+        self.assertEquals(header.type, 7)
+        # empty sequence body has only unit and pad
+        self.assertEquals(header.size, 8)
+
+        # output sequences get the whole capacity back before each run
+        instance.atom_outputs.append(seq)
+        header.size = 8
+        instance.run(64)
+        self.assertEquals(instance.functions.runs, [64])
+        self.assertEquals(header.size, instance.atom_capacity - 8)
+
+        instance.cleanup()
+        self.assertTrue(instance.handle is None)
+
+    def test_only_atom_midi_ports_are_connected(self):
+        instance = Instance.__new__(Instance)
+        instance.handle = 1
+        instance.active = False
+        instance.buffers = {}
+        instance.atom_outputs = []
+        instance.functions = FakeFunctions()
+        instance.urid_map = UridMap()
+        instance.plugin = { 'ports': { 'midi': {
+                    'input': [ { 'index': 2, 'type': 'event' }, { 'index': 3, 'type': 'atom' } ],
+                    'output': [ { 'index': 4, 'type': 'atom' }, { 'index': 5, 'type': 'event' } ],
+                    } } }
+
+        instance.connect_midi()
+        self.assertEquals(sorted(instance.functions.connected.keys()), [3, 4])
+        self.assertEquals(len(instance.atom_outputs), 1)
+        header = Lv2AtomSequence.from_address(instance.functions.connected[3])
+        self.assertEquals(instance.urid_map.unmap(header.type), 'http://lv2plug.in/ns/ext/atom#Sequence')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8
+
+import unittest, os, shutil, tempfile, json
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+from modcommon import indexing
+from modcommon.indexing import EffectIndex, PedalboardIndex, EffectSearcher
+from modcommon.memindex import MemoryEffectIndex, MemoryPedalboardIndex
+from modcommon.tests.test_indexing import effect, PEDALBOARDS
+
+EFFECTS = [ effect(u'a1', u'Reverberator', label=u'Rev', author=u'John Doe', score=3),
+            effect(u'a2', u'Reverse Delay', description=u'Plays the delay backwards', score=5),
+            effect(u'a3', u'Big Muff', category=u'Distortion', brand=u'Other', score=1),
+            effect(u'a4', u'Tape echo', description=u'An old delay',
+                   ports={ 'audio': { 'input': [ {} ], 'output': [ {} ] } }),
+            ]
+
+class MemoryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'effects.idx')
+
+    def tearDown(self):
+        indexing._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_searches_are_the_same_as_whoosh(self):
+        memory = MemoryEffectIndex(self.path)
+        whoosh = EffectIndex(os.path.join(self.tmp_dir, 'whoosh'))
+        memory.add_many(EFFECTS)
+        whoosh.add_many(EFFECTS)
+
+        queries = [ { 'term': [u'rev'] },
+                    { 'term': [u'reverb'] },
+                    { 'term': [u'REVERSE delay'] },
+                    { 'term': [u'delay'], 'category': [u'Delay'] },
+                    { 'term': [u'backwards'] },
+                    { 'term': [u'the backwards'] },
+                    { 'term': [u'doe'] },
+                    { 'term': [u'xyz'] },
+                    { 'category': [u'Delay', u'Distortion'], 'brand': [u'MOD'] },
+                    { 'output_ports': [u'1'] },
+                    { 'where': [u'output_ports>1', u'score<=3'] },
+                    { 'where': [u'output_ports in (1, 3)'], 'term': [u'delay'] },
+                    { 'where': [u'brand in (MOD, Other)', u'score>=1'] },
+                    { 'where': [u'score>3', u'score<5'] },
+                    { 'where': [u'output_ports<1.5'] },
+                    { 'where': [u'output_ports<=1.5'] },
+                    { 'where': [u'output_ports>1.5'] },
+                    { 'where': [u'output_ports>=0.5', u'score<2.5'] },
+                    { 'nofield': [u'x'] },
+                    { 'nofield': [u'x'], 'term': [u'delay'] },
+                    ]
+        for query in queries:
+            self.assertEquals(sorted([ e['id'] for e in memory.term_search(query) ]),
+                              sorted([ e['id'] for e in whoosh.term_search(query) ]))
+
+        self.assertEquals(list(memory.find(url=u'http://portalmod.com/plugins/a3')),
+                          list(whoosh.find(url=u'http://portalmod.com/plugins/a3')))
+        self.assertEquals(list(memory.find(nofield=u'x')), list(whoosh.find(nofield=u'x')))
+        self.assertEquals(list(memory.every(sortedby='score', reverse=True)),
+                          list(whoosh.every(sortedby='score', reverse=True)))
+        self.assertEquals(memory.paginate(memory.every_query(), 2, 3, sortedby='score'),
+                          whoosh.paginate(whoosh.every_query(), 2, 3, sortedby='score'))
+        self.assertEquals(memory.facets(memory.every_query(), ['brand', 'output_ports']),
+                          whoosh.facets(whoosh.every_query(), ['brand', 'output_ports']))
+        self.assertEquals(memory.favorites(2), whoosh.favorites(2))
+
+    def test_snapshot(self):
+        index = MemoryEffectIndex(self.path)
+        index.add_many(EFFECTS)
+        index.delete(u'a2')
+        index.add(effect(u'a1', u'Hall reverb'))
+        # single changes are only written on flush
+        self.assertEquals(MemoryEffectIndex(self.path).generation, 1)
+        index.flush()
+
+        index = MemoryEffectIndex(self.path)
+        self.assertEquals(index.generation, 3)
+        self.assertEquals(sorted([ e['id'] for e in index.every() ]), [u'a1', u'a3', u'a4'])
+        self.assertEquals([ e['id'] for e in index.term_search({ 'term': [u'hall'] }) ], [u'a1'])
+        self.assertEquals(list(index.term_search({ 'term': [u'reverberator'] })), [])
+        self.assertEquals(index.stored(u'a1')['name'], u'Hall reverb')
+
+    def test_deleted_documents_are_compacted(self):
+        index = MemoryEffectIndex(self.path)
+        index.add_many(EFFECTS)
+        index.delete(u'a1')
+        self.assertEquals(len(index.docs), 4)
+        index.delete(u'a2')
+        index.delete(u'a3')
+        self.assertEquals(len(index.docs), 1)
+        self.assertEquals([ e['id'] for e in index.term_search({ 'term': [u'delay'] }) ], [u'a4'])
+        self.assertFalse(index.delete(u'a1'))
+
+    def test_maintenance(self):
+        index = MemoryEffectIndex(self.path)
+        index.add_many(EFFECTS)
+        report = indexing.Maintenance(index, lambda objids: { u'a1': {} }, max_purge=1).run()
+        self.assertEquals(report['purged'], 3)
+        self.assertEquals(report['after']['documents'], 1)
+        index.optimize()
+        self.assertEquals(index.stats()['deleted'], 0)
+        self.assertEquals([ e['id'] for e in index.every() ], [u'a1'])
+
+    def test_scores_and_autocomplete(self):
+        index = MemoryEffectIndex(self.path)
+        index.add_many(EFFECTS)
+        index.scores.increment(effect(u'a4', u'Tape echo'))
+        index.scores.flush()
+        self.assertEquals(index.stored(u'a4')['score'], 1)
+        self.assertEquals([ e['id'] for e in index.autocomplete(u'rev') ], [u'a2', u'a1'])
+
+    def test_pedalboards(self):
+        index = MemoryPedalboardIndex(self.path)
+        index.add({ '_id': u'p1', 'title': u'Heavy metal', 'description': u'Distortion' })
+        index.add({ '_id': u'p2', 'title': u'Ambient', 'description': u'Heavy reverb' })
+        self.assertEquals(sorted([ e['id'] for e in index.term_search({ 'term': [u'heavy'] }) ]),
+                          [u'p1', u'p2'])
+        self.assertEquals(list(index.term_search({ 'term': [u'metal'] })), [{ 'id': u'p1', 'title': u'Heavy metal' }])
+
+    def test_pedalboard_requirements_and_plugins(self):
+        memory = MemoryPedalboardIndex(self.path)
+        memory.add_many(PEDALBOARDS)
+        whoosh = PedalboardIndex(os.path.join(self.tmp_dir, 'whoosh'))
+        whoosh.add_many(PEDALBOARDS)
+
+        delay = u'http://portalmod.com/plugins/delay'
+        for query in ({ 'plugins': [delay] },
+                      { 'plugins': [delay], 'where': [u'footswitch_addressings<=2'] },
+                      { 'where': [u'audio_inputs>=2', u'rotary_addressings=0'] },
+                      { 'where': [u'plugins in (http://portalmod.com/plugins/fuzz, %s)' % delay,
+                                  u'audio_inputs<2'] }):
+            self.assertEquals(sorted([ e['id'] for e in memory.term_search(query) ]),
+                              sorted([ e['id'] for e in whoosh.term_search(query) ]))
+        self.assertEquals([ e['id'] for e in memory.term_search({ 'plugins': [delay] },
+                                                                sortedby='footswitch_addressings') ],
+                          [u'p2', u'p1'])
+
+
+class MemorySearcherTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        super(MemorySearcherTest, self).setUp()
+
+    def tearDown(self):
+        super(MemorySearcherTest, self).tearDown()
+        indexing._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def get_app(self):
+        class Searcher(EffectSearcher):
+            index_class = MemoryEffectIndex
+            index_path = os.path.join(self.tmp_dir, 'effects.idx')
+
+            def get_object(self, objid):
+                return { 'extra': objid.upper() }
+
+        indexing.get_index(MemoryEffectIndex, Searcher.index_path).add_many(EFFECTS)
+        return tornado.web.Application(Searcher.urls('effect'))
+
+    def test_search(self):
+        response = self.fetch('/effect/search/?term=delay&sort=score&reverse=1&page=1')
+        page = json.loads(response.body)
+        self.assertEquals(page['total'], 2)
+        self.assertEquals([ (e['id'], e['extra']) for e in page['results'] ], [(u'a2', u'A2'), (u'a4', u'A4')])
+
+        response = self.fetch('/effect/get/?url=http://portalmod.com/plugins/a3')
+        self.assertEquals(json.loads(response.body), { 'extra': u'A3' })
+
+        response = self.fetch('/effect/facets/?facet=category')
+        self.assertEquals(json.loads(response.body)['facets'], { 'category': [[u'Delay', 3], [u'Distortion', 1]] })
@@ -0,0 +1,77 @@
+# -*- coding: utf-8
+
+import unittest
+from modcommon import pedalboard
+
+def address(hwtype, acttype):
+    return { 'actuator': [hwtype, 0, acttype, 0] }
+
+BOARDS = [
+    # stereo, two footswitches and a rotary
+    { 'connections': [ ('system', 'capture_1', 'delay', 'in_l'),
+                       ('system', 'capture_2', 'delay', 'in_r'),
+                       ('delay', 'out_l', 'system', 'playback_1'),
+                       ('delay', 'out_r', 'system', 'playback_2') ],
+      'instances': [ { 'addressing': { 'on': address(0, 1),
+                                       'tap': address(0, 1),
+                                       'time': address(0, 2) } } ],
+      },
+    # mono with midi in and an expression pedal
+    { 'connections': [ ('system', 'capture_1', 'wah', 'in'),
+                       ('system', 'midi_capture_1', 'wah', 'midi'),
+                       ('wah', 'out', 'system', 'playback_1') ],
+      'instances': [ { 'addressing': { 'freq': address(1, 7) } },
+                     { } ],
+      },
+    # nothing connected to hardware
+    { 'connections': [], 'instances': [] },
+    ]
+
+class PedalboardTest(unittest.TestCase):
+
+    def test_hardware_connections(self):
+        self.assertEquals(pedalboard.hardware_connections(BOARDS[1]),
+                          { 'audio_inputs': 1, 'audio_outputs': 1,
+                            'midi_inputs': 1, 'midi_outputs': 0,
+                            'footswitch_addressings': 0, 'rotary_addressings': 0,
+                            'pedal_addressings': 1 })
+
+    def test_actuator_table(self):
+        actuators = ((0, None, 'footswitch'), (2, 1, 'knob'))
+        m = pedalboard.hardware_connections(BOARDS[0], actuators)
+        self.assertEquals(m['footswitch_addressings'], 3)
+        self.assertEquals(m['knob_addressings'], 0)
+        self.assertFalse('rotary_addressings' in m)
+
+    def test_requirements(self):
+        columns = pedalboard.requirement_columns()
+        matrix = pedalboard.requirements(BOARDS)
+        self.assertEquals(len(matrix), 3)
+        for board, row in zip(BOARDS, matrix):
+            m = pedalboard.hardware_connections(board)
+            self.assertEquals(list(row), [ m[column] for column in columns ])
+
+    def test_requirements_empty(self):
+        self.assertEquals(len(pedalboard.requirements([])), 0)
+
+    def test_fits(self):
+        matrix = pedalboard.requirements(BOARDS)
+        quadra = { 'audio_inputs': 2, 'audio_outputs': 2,
+                   'footswitch_addressings': 4, 'rotary_addressings': 4 }
+        self.assertEquals(list(pedalboard.fits(matrix, quadra)), [True, False, True])
+        quadra['midi_inputs'] = 1
+        quadra['pedal_addressings'] = 1
+        quadra['footswitch_addressings'] = 1
+        self.assertEquals(list(pedalboard.fits(matrix, quadra)), [False, True, True])
+
+    def test_fits_python(self):
+        numpy = pedalboard.numpy
+        pedalboard.numpy = None
+        try:
+            matrix = pedalboard.requirements(BOARDS)
+            self.assertEquals(type(matrix), list)
+            self.assertEquals(pedalboard.fits(matrix, { 'audio_inputs': 1, 'audio_outputs': 1,
+                                                        'midi_inputs': 1, 'pedal_addressings': 1 }),
+                              [False, True, True])
+        finally:
+            pedalboard.numpy = numpy
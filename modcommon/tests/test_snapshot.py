@@ -0,0 +1,72 @@
+# -*- coding: utf-8
+
+import unittest, os, sys, shutil, tempfile, json, tarfile
+from cStringIO import StringIO
+from modcommon import indexing, snapshot
+from modcommon.indexing import EffectIndex
+from modcommon.tests.test_indexing import effect
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'effects')
+
+    def tearDown(self):
+        indexing._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def package(self, name, effects):
+        path = os.path.join(self.tmp_dir, name)
+        manifest = snapshot.build(EffectIndex, effects, path, procs=2)
+        filename = path + '.tgz'
+        self.assertEquals(snapshot.package(path, filename), manifest['checksum'])
+        return filename
+
+    def test_snapshot_is_adopted(self):
+        filename = self.package('build', [ effect(u'a%d' % i, u'Effect %d' % i) for i in range(20) ])
+
+        # index built locally is replaced
+        EffectIndex(self.index_path).add(effect(u'b1', u'Local'))
+        index = EffectIndex(self.index_path, snapshot=filename)
+        self.assertEquals(len(list(index.every())), 20)
+        self.assertEquals(len(index.index._segments()), 1)
+        self.assertEquals(os.listdir(self.tmp_dir).count('effects.old'), 0)
+
+        # already installed
+        self.assertFalse(snapshot.install(filename, self.index_path))
+
+        filename = self.package('build2', [ effect(u'c1', u'New effect') ])
+        index = indexing.get_index(EffectIndex, self.index_path, filename)
+        self.assertEquals([ e['id'] for e in index.every() ], [u'c1'])
+
+    def test_corrupted_snapshot_is_rejected(self):
+        filename = self.package('build', [ effect(u'a1', u'Effect') ])
+        path = os.path.join(self.tmp_dir, 'build')
+        for name in os.listdir(path):
+            if name.endswith('.seg'):
+                open(os.path.join(path, name), 'a').write('garbage')
+        tar = tarfile.open(filename, 'w:gz')
+        tar.add(path, arcname='index')
+        tar.close()
+
+        EffectIndex(self.index_path).add(effect(u'b1', u'Local'))
+        self.assertRaises(snapshot.InvalidSnapshot, EffectIndex, self.index_path, filename)
+        self.assertEquals([ e['id'] for e in EffectIndex(self.index_path).every() ], [u'b1'])
+
+    def test_main(self):
+        catalog = os.path.join(self.tmp_dir, 'catalog.json')
+        json.dump([ effect(u'a1', u'Effect') ], open(catalog, 'w'))
+        filename = os.path.join(self.tmp_dir, 'effects.tgz')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            snapshot.main(['effect', catalog, filename])
+            manifest = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        self.assertEquals(manifest['documents'], 1)
+        self.assertEquals(manifest['index'], 'EffectIndex')
+
+        index = EffectIndex(self.index_path, snapshot=filename)
+        self.assertEquals([ e['id'] for e in index.every() ], [u'a1'])
@@ -8,7 +8,7 @@ setup(name = 'modcommon',
       author_email = "lhfagundes@hacklab.com.br",
       license = "GPLv3",
       packages = find_packages(),
-      install_requires = ['rdflib', 'whoosh', 'pymongo'],
+      install_requires = ['rdflib', 'whoosh', 'pymongo', 'futures'],
       classifiers = [
           'Intended Audience :: Developers',
           'Natural Language :: English',